@@ -0,0 +1,77 @@
+"""Compara memoria y recall entre el modo TF-IDF clásico y el modo hashing.
+
+Uso: python bench_vectorizers.py [ruta.pdf] [--queries N] [--k K]
+
+Las consultas se generan tomando ventanas de palabras de fragmentos al azar; una
+consulta se considera recuperada si su fragmento de origen aparece en el top-k."""
+import argparse
+import pickle
+import random
+import time
+
+import main
+
+def sparse_bytes(m) -> int:
+    return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+
+def make_queries(chunks, n: int, words: int = 12, seed: int = 0):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        idx = rng.randrange(len(chunks))
+        toks = chunks[idx].split()
+        start = rng.randrange(max(1, len(toks) - words))
+        queries.append((idx, " ".join(toks[start:start + words])))
+    return queries
+
+def evaluate(kb, queries, k: int):
+    hits = 0
+    tops = []
+    started = time.perf_counter()
+    for idx, q in queries:
+        top = [i for i, _, _ in main.retrieve_context(kb, q, k=k)]
+        hits += idx in top
+        tops.append(top)
+    elapsed = (time.perf_counter() - started) / max(1, len(queries))
+    return hits / max(1, len(queries)), tops, elapsed
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pdf", nargs="?", default=main.PDF_PATH)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    text = main.read_pdf_text(args.pdf)
+    chunks = main.chunk_text(text, max_tokens=400, overlap=100)
+    queries = make_queries(chunks, args.queries)
+
+    results = {}
+    for mode in ("tfidf", "hashing"):
+        started = time.perf_counter()
+        kb = main.build_kb_from_chunks(chunks, mode=mode)
+        build_s = time.perf_counter() - started
+        recall, tops, query_s = evaluate(kb, queries, args.k)
+
+        # Añadir un 10% extra de fragmentos: reajuste completo vs. ingesta incremental
+        base = main.build_kb_from_chunks(chunks[: int(len(chunks) * 0.9)], mode=mode)
+        started = time.perf_counter()
+        main.append_to_kb(base, chunks[int(len(chunks) * 0.9):])
+        append_s = time.perf_counter() - started
+
+        results[mode] = tops
+        print(
+            f"{mode:8s} fragmentos={len(chunks)} vectorizador={len(pickle.dumps(kb.vectorizer)) / 1e6:.2f}MB "
+            f"matriz={sparse_bytes(kb.matrix) / 1e6:.2f}MB nnz={kb.matrix.nnz} "
+            f"build={build_s:.2f}s append10%={append_s:.3f}s "
+            f"recall@{args.k}={recall:.3f} consulta={query_s * 1000:.1f}ms"
+        )
+
+    overlap = [
+        len(set(a) & set(b)) / max(1, len(a))
+        for a, b in zip(results["tfidf"], results["hashing"])
+    ]
+    print(f"Solapamiento top-{args.k} tfidf vs hashing: {sum(overlap) / max(1, len(overlap)):.3f}")
+
+if __name__ == "__main__":
+    main_cli()
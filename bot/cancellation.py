@@ -0,0 +1,147 @@
+import time
+import asyncio
+import functools
+import threading
+import logging
+from typing import Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger("uni-bot")
+
+class RequestCancelled(Exception):
+    """La petición fue reemplazada, venció su plazo o el bot se está deteniendo."""
+
+class CancelToken:
+    """Plazo extremo a extremo y cancelación cooperativa de una petición.
+
+    Se comparte entre el event loop y el hilo que llama al modelo: `cancel()` puede
+    invocarse desde cualquier hilo y ejecuta los callbacks registrados (por ejemplo,
+    cerrar la conexión HTTP con el servidor del modelo)."""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def cancel(self, reason: str = "cancelada") -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception:
+                logger.exception("Error en callback de cancelación")
+
+    def check(self) -> None:
+        if self.expired and not self.cancelled:
+            self.cancel("plazo vencido")
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+    def wait(self, seconds: float) -> bool:
+        """Espera interrumpible; devuelve True si la petición se canceló."""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        return self._event.wait(seconds)
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Registra `callback` (se ejecuta de inmediato si ya está cancelada) y devuelve
+        una función para desregistrarlo."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+# -----------------------------
+# Peticiones activas por (chat, usuario)
+# -----------------------------
+_ACTIVE: Dict[Hashable, CancelToken] = {}
+_ACTIVE_LOCK = threading.Lock()
+
+def request_key(chat_id: int, user_id: Optional[int]) -> Hashable:
+    """Clave de la petición en curso: en un grupo cada miembro tiene la suya, así la pregunta
+    de un estudiante no cancela la de otro."""
+    return (chat_id, user_id)
+
+def register_request(key: Hashable, token: CancelToken) -> None:
+    """Registra la petición en curso de `key` y cancela la anterior, que ya no es relevante."""
+    with _ACTIVE_LOCK:
+        previous = _ACTIVE.get(key)
+        _ACTIVE[key] = token
+    if previous is not None and previous is not token:
+        previous.cancel("reemplazada por una pregunta más reciente")
+
+def unregister_request(key: Hashable, token: CancelToken) -> None:
+    with _ACTIVE_LOCK:
+        if _ACTIVE.get(key) is token:
+            del _ACTIVE[key]
+
+def cancel_all_requests(reason: str = "bot detenido") -> int:
+    with _ACTIVE_LOCK:
+        tokens = list(_ACTIVE.values())
+        _ACTIVE.clear()
+    for token in tokens:
+        token.cancel(reason)
+    if tokens:
+        logger.info(f"{len(tokens)} peticiones en curso canceladas ({reason}).")
+    return len(tokens)
+
+async def run_cancellable(func, *args, token: CancelToken, **kwargs):
+    """Ejecuta `func(*args, token=token, **kwargs)` en un hilo y deja de esperarla en cuanto
+    la petición se cancela o vence su plazo. El hilo termina por su cuenta cuando el token
+    cierra la conexión con el modelo."""
+    loop = asyncio.get_running_loop()
+    work = loop.run_in_executor(None, functools.partial(func, *args, token=token, **kwargs))
+    stopped = loop.create_future()
+
+    def wake():
+        if not stopped.done():
+            stopped.set_result(None)
+
+    def on_cancel():
+        try:
+            loop.call_soon_threadsafe(wake)
+        except RuntimeError:
+            # El loop ya está cerrado
+            pass
+
+    unregister = token.on_cancel(on_cancel)
+    try:
+        done, _ = await asyncio.wait({work, stopped}, timeout=token.remaining(), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        token.cancel("tarea cancelada")
+        raise
+    finally:
+        unregister()
+    if work in done and not token.cancelled:
+        return work.result()
+    token.cancel(token.reason or "plazo vencido")
+    # Evitar el aviso de excepción no recuperada cuando el hilo termine
+    work.add_done_callback(lambda f: f.cancelled() or f.exception())
+    raise RequestCancelled(token.reason)
@@ -0,0 +1,211 @@
+"""CLI sin interfaz gráfica del bot académico.
+
+Subcomandos:
+  build   construir el índice desde un PDF y guardarlo en disco
+  verify  comprobar un índice guardado (estructura, PDF de origen y consulta de prueba)
+  query   responder una pregunta
+  batch   responder preguntas JSONL en paralelo y emitir respuestas JSONL
+  serve   levantar el bot de Telegram
+
+Ejemplos:
+  python cli.py build --pdf apuntes.pdf --out apuntes.idx
+  python cli.py batch --index apuntes.idx --in preguntas.jsonl --out respuestas.jsonl --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import main
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+def load_kb_from_args(args) -> main.KnowledgeBase:
+    if getattr(args, "index", None):
+        return main.load_kb(args.index)
+    pdf = getattr(args, "pdf", None) or main.PDF_PATH
+    if not os.path.exists(pdf):
+        raise SystemExit(f"No se encuentra el PDF en {pdf}")
+    return main.build_kb_from_pdf(pdf)
+
+def add_source_args(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--index", help="índice construido con 'build'")
+    group.add_argument("--pdf", help="PDF a indexar al vuelo (por defecto PDF_PATH)")
+
+# -----------------------------
+# Subcomandos
+# -----------------------------
+def cmd_build(args) -> int:
+    started = time.perf_counter()
+    kb = main.build_kb_from_pdfs([args.pdf], mode=args.mode, dedup=not args.no_dedup)
+    main.save_kb(kb, args.out)
+    print(f"Índice: {args.out} ({len(kb.chunks)} fragmentos, {time.perf_counter() - started:.1f}s)")
+    return 0
+
+def cmd_verify(args) -> int:
+    kb = main.load_kb(args.index)
+    problems = []
+    if kb.matrix.shape[0] != len(kb.chunks):
+        problems.append(f"la matriz tiene {kb.matrix.shape[0]} filas para {len(kb.chunks)} fragmentos")
+    if kb.counts is not None and kb.counts.shape[0] != len(kb.chunks):
+        problems.append("los conteos no coinciden con los fragmentos")
+
+    documents = main.source_documents(kb.source)
+    if args.pdf and len(documents) == 1:
+        documents = [dict(documents[0], path=args.pdf)]
+    for doc in documents:
+        pdf = doc.get("path")
+        if not os.path.exists(pdf):
+            problems.append(f"no se encuentra el PDF de origen {pdf}")
+        elif main.pdf_fingerprint(pdf)["sha256"] != doc.get("sha256"):
+            problems.append(f"el PDF {pdf} cambió desde que se construyó el índice")
+
+    sample = kb.chunks[0].split()[:12] if kb.chunks else []
+    if sample:
+        top = main.retrieve_context(kb, " ".join(sample), k=1)
+        if not top or top[0][0] != 0:
+            problems.append("la consulta de prueba no recupera su propio fragmento")
+
+    for problem in problems:
+        print(f"ERROR: {problem}")
+    if not problems:
+        print(f"Índice correcto: {len(kb.chunks)} fragmentos, {kb.matrix.nnz} valores no nulos.")
+    return 1 if problems else 0
+
+def cmd_query(args) -> int:
+    kb = load_kb_from_args(args)
+    if args.no_llm:
+        _, contexts = main.prepare_messages(kb, args.question)
+        for idx, chunk, score in contexts:
+            print(f"[Fragmento {idx} | score {score:.3f}] {chunk[:300]}\n")
+        return 0
+    answer, contexts = main.answer_question(kb, args.question)
+    print(f"{answer}\n\nReferencias usadas:\n{main.format_references(contexts, kb)}")
+    return 0
+
+def _answer_record(kb: main.KnowledgeBase, record: dict) -> dict:
+    if "error" in record:
+        # Línea inválida: se informa en la salida sin llamar al modelo
+        return {"id": record.get("id"), "error": record["error"]}
+    started = time.perf_counter()
+    out = {"id": record.get("id"), "question": record.get("question", "")}
+    try:
+        answer, contexts = main.answer_question(kb, out["question"])
+        out["answer"] = answer
+        out["references"] = [
+            {"fragment": idx, "score": round(score, 4), "pages": kb.pages[idx] if kb.pages else []}
+            for idx, _, score in contexts
+        ]
+    except Exception as e:
+        out["error"] = str(e)
+    out["elapsed"] = round(time.perf_counter() - started, 3)
+    return out
+
+def _read_questions(stream):
+    for n, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # Línea de texto plano: la pregunta es la línea completa
+            record = {"question": line}
+        if isinstance(record, str):
+            record = {"question": record}
+        if not isinstance(record, dict):
+            yield {"id": n, "error": f"línea {n}: se esperaba un objeto JSON o una cadena"}
+            continue
+        record.setdefault("id", n)
+        question = record.get("question")
+        if not isinstance(question, str) or not question.strip():
+            yield {"id": record["id"], "error": f"línea {n}: falta el campo 'question'"}
+            continue
+        yield record
+
+def cmd_batch(args) -> int:
+    kb = load_kb_from_args(args)
+    src = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    done = errors = 0
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            pending = set()
+            # Ventana acotada: no leer ni encolar más de 2x workers preguntas a la vez
+            for record in _read_questions(src):
+                if len(pending) >= args.workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        result = fut.result()
+                        errors += "error" in result
+                        done += 1
+                        dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    dst.flush()
+                pending.add(pool.submit(_answer_record, kb, record))
+            for fut in wait(pending).done:
+                result = fut.result()
+                errors += "error" in result
+                done += 1
+                dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+            dst.flush()
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{done} preguntas en {elapsed:.1f}s ({done / max(elapsed, 1e-9):.2f}/s), {errors} errores.",
+        file=sys.stderr,
+    )
+    return 1 if errors else 0
+
+def cmd_serve(args) -> int:
+    kb = load_kb_from_args(args)
+    main.main(kb)
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Bot académico sin interfaz gráfica.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="construir y guardar el índice de un PDF")
+    p.add_argument("--pdf", default=main.PDF_PATH)
+    p.add_argument("--out", required=True)
+    p.add_argument("--mode", choices=("tfidf", "hashing"), default=None)
+    p.add_argument("--no-dedup", action="store_true", help="no fusionar fragmentos casi duplicados")
+    p.set_defaults(func=cmd_build)
+
+    p = sub.add_parser("verify", help="comprobar un índice guardado")
+    p.add_argument("index")
+    p.add_argument("--pdf", help="PDF con el que comparar (por defecto el de origen)")
+    p.set_defaults(func=cmd_verify)
+
+    p = sub.add_parser("query", help="responder una pregunta")
+    p.add_argument("question")
+    add_source_args(p)
+    p.add_argument("--no-llm", action="store_true", help="mostrar solo los fragmentos recuperados")
+    p.set_defaults(func=cmd_query)
+
+    p = sub.add_parser("batch", help="responder preguntas JSONL en paralelo")
+    p.add_argument("--in", dest="input", default="-", help="JSONL con {'id', 'question'} (- para stdin)")
+    p.add_argument("--out", dest="output", default="-", help="JSONL de salida (- para stdout)")
+    p.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    add_source_args(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("serve", help="levantar el bot de Telegram")
+    add_source_args(p)
+    p.set_defaults(func=cmd_serve)
+    return parser
+
+def run(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,7 +1,10 @@
+import os
+import json
 import sqlite3
 from pathlib import Path
 
-DB_PATH = Path(__file__).parent / "data.db"
+# BOT_DB_PATH permite usar otra base (por ejemplo, una temporal en las pruebas de carga)
+DB_PATH = Path(os.getenv("BOT_DB_PATH") or Path(__file__).parent / "data.db")
 
 def init_db() -> None:
     conn = sqlite3.connect(DB_PATH)
@@ -38,3 +41,52 @@ def get_kv(key: str) -> str | None:
         return row[0] if row else None
     finally:
         conn.close()
+
+# La tabla de documentos por chat se crea con la primera asignación (/documentos), no en
+# init_db: así importar el bot no modifica una base existente
+def _create_chat_documents(cur) -> None:
+    cur.execute("CREATE TABLE IF NOT EXISTS chat_documents (chat_id INTEGER PRIMARY KEY, paths TEXT)")
+
+def set_chat_documents(chat_id: int, paths: list[str]) -> None:
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
+        _create_chat_documents(cur)
+        cur.execute("REPLACE INTO chat_documents (chat_id, paths) VALUES (?, ?)", (chat_id, json.dumps(paths)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_chat_documents(chat_id: int) -> list[str] | None:
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT paths FROM chat_documents WHERE chat_id = ?", (chat_id,))
+        row = cur.fetchone()
+        return json.loads(row[0]) if row else None
+    except sqlite3.OperationalError:
+        # Aún no se ha asignado ningún documento: la tabla no existe
+        return None
+    finally:
+        conn.close()
+
+def clear_chat_documents(chat_id: int) -> None:
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
+        _create_chat_documents(cur)
+        cur.execute("DELETE FROM chat_documents WHERE chat_id = ?", (chat_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_all_chat_documents() -> dict[int, list[str]]:
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT chat_id, paths FROM chat_documents")
+        return {chat_id: json.loads(paths) for chat_id, paths in cur.fetchall()}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
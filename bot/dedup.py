@@ -0,0 +1,113 @@
+import os
+import re
+import zlib
+import logging
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("uni-bot")
+
+# Similitud de Jaccard (estimada) a partir de la cual dos fragmentos se consideran el mismo
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "64"))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+DEDUP_SHINGLE = int(os.getenv("DEDUP_SHINGLE", "5"))
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_RE = re.compile(r"\w+")
+# Marcas de página ("[Página 3]" o "[a.pdf | Página 3]"): no cuentan para la similitud
+_PAGE_MARK_RE = re.compile(r"\[(?:[^\[\]|]+ \| )?Página \d+\]")
+
+def shingles(text: str, size: int = DEDUP_SHINGLE) -> np.ndarray:
+    """Hashes de 32 bits de los n-gramas de palabras del texto (sin marcas de página)."""
+    words = _WORD_RE.findall(_PAGE_MARK_RE.sub(" ", text).lower())
+    if len(words) < size:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+class MinHashLSH:
+    """Índice LSH por bandas sobre firmas MinHash. Con b bandas de r filas, dos textos con
+    Jaccard s coinciden en alguna banda con probabilidad 1 - (1 - s^r)^b; los candidatos
+    se confirman comparando la firma completa contra `threshold`."""
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = DEDUP_NUM_PERM,
+                 bands: int = DEDUP_BANDS, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm debe ser múltiplo de bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 61, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 61, size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, int]] = [{} for _ in range(bands)]
+        self._signatures: List[np.ndarray] = []
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        if hashes.size == 0:
+            return np.full(self._a.size, _MAX_HASH, dtype=np.uint64)
+        # Permutaciones universales (a·h + b) mod p, truncadas a 32 bits (el desbordamiento de uint64 es intencionado)
+        with np.errstate(over="ignore"):
+            perm = (np.outer(hashes, self._a) + self._b) % _MERSENNE & _MAX_HASH
+        return perm.min(axis=0)
+
+    def query(self, sig: np.ndarray) -> int:
+        """Índice del elemento ya insertado más parecido por encima del umbral, o -1."""
+        best, best_sim = -1, self.threshold
+        seen = set()
+        for band, bucket in enumerate(self._buckets):
+            key = sig[band * self.rows:(band + 1) * self.rows].tobytes()
+            idx = bucket.get(key)
+            if idx is None or idx in seen:
+                continue
+            seen.add(idx)
+            sim = float(np.mean(self._signatures[idx] == sig))
+            if sim >= best_sim:
+                best, best_sim = idx, sim
+        return best
+
+    def insert(self, sig: np.ndarray) -> int:
+        idx = len(self._signatures)
+        self._signatures.append(sig)
+        for band, bucket in enumerate(self._buckets):
+            bucket.setdefault(sig[band * self.rows:(band + 1) * self.rows].tobytes(), idx)
+        return idx
+
+class DedupStats:
+    def __init__(self):
+        self.seen = 0
+        self.merged = 0
+
+    @property
+    def kept(self) -> int:
+        return self.seen - self.merged
+
+    def describe(self) -> str:
+        ratio = self.merged / self.seen if self.seen else 0.0
+        return f"Deduplicación: {self.merged}/{self.seen} fragmentos casi duplicados fusionados ({ratio:.1%})."
+
+def dedupe_chunks(items: Iterable[Tuple[str, List[str]]], lsh: MinHashLSH = None,
+                  stats: DedupStats = None) -> Iterator[Tuple[str, List[str]]]:
+    """Filtra en flujo los fragmentos casi idénticos a uno ya emitido. Recibe y produce
+    (fragmento, páginas); las páginas de un duplicado se añaden a la lista del fragmento
+    que se conserva, que el consumidor debe leer cuando el flujo se haya agotado."""
+    lsh = lsh or MinHashLSH()
+    stats = stats if stats is not None else DedupStats()
+    kept_pages: List[List[str]] = []
+    for chunk, pages in items:
+        stats.seen += 1
+        sig = lsh.signature(shingles(chunk))
+        match = lsh.query(sig)
+        if match >= 0:
+            stats.merged += 1
+            target = kept_pages[match]
+            target.extend(p for p in pages if p not in target)
+            continue
+        pages = list(pages)
+        kept_pages.append(pages)
+        lsh.insert(sig)
+        yield chunk, pages
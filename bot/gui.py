@@ -10,6 +10,7 @@ from pathlib import Path
 import asyncio
 import main
 import db
+import profiling
 from telegram.error import Conflict
 
 # Configurar CustomTkinter
@@ -46,6 +47,7 @@ class BotGUI:
         self.bot_thread = None
         self.stop_event = threading.Event()
         self.app = None
+        self.bot_loop = None
 
         # Crear widgets
         self.create_widgets()
@@ -98,6 +100,11 @@ class BotGUI:
         self.stop_button = ctk.CTkButton(button_frame, text="Detener Bot", state="disabled", command=self.stop_bot)
         self.stop_button.pack(side="left", padx=10)
 
+        # Profiling bajo demanda (cProfile en una fracción de las preguntas, tracemalloc al construir la KB)
+        self.profiling_var = ctk.BooleanVar(value=profiling.STATE.enabled)
+        self.profiling_switch = ctk.CTkSwitch(button_frame, text="Profiling", variable=self.profiling_var, command=self.toggle_profiling)
+        self.profiling_switch.pack(side="right", padx=10)
+
         # Área de logs
         log_label = ctk.CTkLabel(main_frame, text="Logs:")
         log_label.pack(pady=5)
@@ -105,6 +112,10 @@ class BotGUI:
         self.log_text = ctk.CTkTextbox(main_frame, wrap="word", height=200)
         self.log_text.pack(pady=5, padx=10, fill="both", expand=True)
 
+    def toggle_profiling(self):
+        profiling.STATE.set(bool(self.profiling_var.get()))
+        logging.getLogger("uni-bot").info(profiling.STATE.describe())
+
     def setup_logging(self):
         logger = logging.getLogger("uni-bot")
         logger.setLevel(logging.INFO)
@@ -414,15 +425,13 @@ class BotGUI:
             if main.TELEGRAM_TOKEN.startswith("REEMPLAZA"):
                 raise ValueError("Debes configurar TELEGRAM_TOKEN en variables de entorno.")
 
-            self.app = main.ApplicationBuilder().token(main.TELEGRAM_TOKEN).build()
-            self.app.add_handler(main.CommandHandler("start", main.start))
-            self.app.add_handler(main.CommandHandler("help", main.help_cmd))
-            self.app.add_handler(main.MessageHandler(main.filters.TEXT & (~main.filters.COMMAND), main.ask))
+            self.app = main.build_application(main.TELEGRAM_TOKEN)
 
             logger.info("Bot en ejecución. Ctrl+C para salir.")
             # Crear y asignar un event loop en este hilo; necesario para python-telegram-bot
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
+            self.bot_loop = loop
             try:
                 # run_polling usará el loop actual
                 self.app.run_polling(poll_interval=1)
@@ -464,12 +473,16 @@ class BotGUI:
             # El hilo terminó, permitir reinicio
             self.bot_thread = None
             self.app = None
+            self.bot_loop = None
 
     def stop_bot(self):
-        if self.app:
+        # Cortar primero las generaciones en curso para que los handlers terminen enseguida
+        main.cancel_all_requests("bot detenido")
+        if self.app and self.bot_loop:
             try:
-                self.app.stop()
-            except:
+                # stop_running debe ejecutarse dentro del loop del bot
+                self.bot_loop.call_soon_threadsafe(self.app.stop_running)
+            except RuntimeError:
                 pass
         self.stop_event.set()
         if self.bot_thread:
@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable
+
+logger = logging.getLogger("uni-bot")
+
+# Presupuesto de memoria para las KBs cargadas por conjunto de documentos
+KB_CACHE_MAX_MB = float(os.getenv("KB_CACHE_MAX_MB", "512"))
+
+def _array_bytes(obj) -> int:
+    if obj is None:
+        return 0
+    if hasattr(obj, "indptr"):  # matriz dispersa CSR/CSC
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    return getattr(obj, "nbytes", 0)
+
+def _strings_bytes(items) -> int:
+    return sum(sys.getsizeof(s) for s in items)
+
+def estimate_kb_bytes(kb) -> int:
+    """Estimación (por lo bajo) de la memoria que ocupa una KB: matrices, textos de los
+    fragmentos y estado del vectorizador. NearestNeighbors comparte la matriz y no suma."""
+    total = _array_bytes(kb.matrix) + _array_bytes(kb.counts)
+    total += sys.getsizeof(kb.chunks) + _strings_bytes(kb.chunks)
+    vec = kb.vectorizer
+    vocab = getattr(vec, "vocabulary_", None)
+    if vocab:
+        # Claves + enteros (28 bytes) + tabla del dict
+        total += sys.getsizeof(vocab) + _strings_bytes(vocab) + 28 * len(vocab)
+    stop_words = getattr(vec, "stop_words_", None)
+    if stop_words:
+        total += sys.getsizeof(stop_words) + _strings_bytes(stop_words)
+    for attr in ("idf_", "df", "_idf"):
+        try:
+            total += _array_bytes(getattr(vec, attr, None))
+        except Exception:
+            # idf_ de TfidfVectorizer lanza si aún no está ajustado
+            pass
+    return total
+
+class KBStore:
+    """LRU de KBs cargadas, acotado por memoria estimada en lugar de número de entradas.
+
+    `loader(key)` carga o construye la KB la primera vez que se pide; si varias peticiones
+    piden la misma clave a la vez, solo una la construye y las demás esperan su resultado.
+    `get` es bloqueante: desde el event loop hay que llamarlo en un executor."""
+
+    def __init__(self, loader: Callable[[Hashable], Any], max_bytes: int,
+                 sizeof: Callable[[Any], int] = estimate_kb_bytes, name: str = "KBs cargadas"):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.name = name
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()  # clave -> (kb, bytes)
+        self._bytes = 0
+        self._pending: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return entry[0]
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            kb = self.loader(key)
+            # Fuera del lock: la estimación recorre todos los fragmentos
+            size = self.sizeof(kb)
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(key, None)
+            future.set_exception(e)
+            raise
+        self._insert(key, kb, size)
+        future.set_result(kb)
+        return kb
+
+    def _insert(self, key: Hashable, kb: Any, size: int) -> None:
+        evicted = []
+        with self._lock:
+            # Publicar la entrada y retirar la construcción pendiente a la vez: una petición
+            # concurrente ve siempre una de las dos y nunca lanza una segunda construcción
+            self._pending.pop(key, None)
+            self.loads += 1
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (kb, size)
+            self._bytes += size
+            # Nunca se expulsa la KB recién cargada, aunque por sí sola supere el presupuesto
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                old_key, (_, old_size) = self._data.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            logger.info(f"{self.name}: expulsada {old_key} para liberar memoria.")
+        if size > self.max_bytes:
+            logger.warning(
+                f"{self.name}: la KB {key} ocupa ~{size / 2**20:.1f} MB, más que el presupuesto "
+                f"de {self.max_bytes / 2**20:.0f} MB."
+            )
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def describe(self) -> str:
+        with self._lock:
+            count, used = len(self._data), self._bytes
+        return (
+            f"{self.name}: {count} en memoria, ~{used / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MB, "
+            f"{self.hits} aciertos, {self.loads} cargas, {self.evictions} expulsiones"
+        )
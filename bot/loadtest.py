@@ -0,0 +1,365 @@
+"""Generador de carga extremo a extremo para el handler `ask`.
+
+Levanta un servidor local compatible con la API de OpenAI (latencia y tokens/s
+configurables) y una Bot API de Telegram simulada, y alimenta la aplicación real de
+python-telegram-bot con updates sintéticos de muchos chats. Para cada nivel de
+concurrencia (estudiantes simultáneos) informa throughput sostenido, latencia
+p50/p95/p99, crecimiento de colas y tasa de error.
+
+Uso: python loadtest.py --levels 1,4,16,64 --duration 20 --lm-tps 40
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs
+
+from telegram import Update
+
+# No tocar la base local del bot (data.db está versionada): usar una temporal
+os.environ.setdefault("BOT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="uni-bot-loadtest-"), "data.db"))
+
+import main
+import sender
+
+QUESTIONS = [
+    "¿Qué es la inteligencia artificial?",
+    "Explica las aplicaciones de las redes neuronales en ingeniería.",
+    "¿Cómo se usa el aprendizaje automático en la industria?",
+    "¿Qué desafíos éticos plantea la automatización?",
+    "Resume las ventajas de los sistemas expertos.",
+    "¿Qué es el internet de las cosas y para qué sirve?",
+    "Diferencias entre aprendizaje supervisado y no supervisado.",
+    "¿Qué papel tiene la visión por computador en la ingeniería del futuro?",
+]
+FAST_PATH = ["hola", "gracias", "chao"]
+
+_FILLER = (
+    "La inteligencia artificial permite automatizar tareas de análisis en ingeniería "
+    "y mejorar la toma de decisiones a partir de datos del documento. "
+).split()
+
+# -----------------------------
+# Servidor LM simulado (compatible con OpenAI)
+# -----------------------------
+@dataclass
+class MockLMConfig:
+    latency: float = 0.2          # segundos fijos por petición
+    prefill_tps: float = 2000.0   # tokens de prompt procesados por segundo
+    tps: float = 40.0             # tokens generados por segundo
+    answer_tokens: int = 150      # tokens de la respuesta (acotado por max_tokens)
+    slots: int = 1                # generaciones simultáneas (LM Studio atiende de a una)
+
+class _MockLMHandler(BaseHTTPRequestHandler):
+    config: MockLMConfig
+    slots: threading.Semaphore
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        prompt_chars = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+        prompt_tokens = prompt_chars // 4
+        n_tokens = min(int(payload.get("max_tokens", self.config.answer_tokens)), self.config.answer_tokens)
+        with self.slots:
+            time.sleep(self.config.latency + prompt_tokens / self.config.prefill_tps)
+            if payload.get("stream"):
+                self._stream(n_tokens)
+                return
+            time.sleep(n_tokens / self.config.tps)
+        content = " ".join(_FILLER[i % len(_FILLER)] for i in range(n_tokens))
+        body = json.dumps({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": n_tokens},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, n_tokens: int):
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i in range(n_tokens):
+                time.sleep(1.0 / self.config.tps)
+                delta = {"choices": [{"index": 0, "delta": {"content": _FILLER[i % len(_FILLER)] + " "}}]}
+                self.wfile.write(f"data: {json.dumps(delta)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente canceló la generación (también antes de recibir las cabeceras)
+            pass
+
+def start_mock_lm(config: MockLMConfig) -> ThreadingHTTPServer:
+    handler = type("MockLMHandler", (_MockLMHandler,), {"config": config, "slots": threading.Semaphore(config.slots)})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -----------------------------
+# Bot API de Telegram simulada
+# -----------------------------
+class MockBotAPI:
+    """Responde getMe/sendMessage y notifica al generador cada mensaje enviado a un chat."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, rate_limit_prob: float = 0.0):
+        self.loop = loop
+        self.rate_limit_prob = rate_limit_prob
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.sent = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length).decode()
+                if "json" in self.headers.get("Content-Type", ""):
+                    params = json.loads(raw or "{}")
+                else:
+                    params = {k: v[0] for k, v in parse_qs(raw).items()}
+                status, body = api.handle(method, params)
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # El bot se detuvo con un getUpdates en curso
+                    pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    def handle(self, method: str, params: dict):
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}}
+        if method == "getUpdates":
+            # Sin updates reales: simular un long polling corto
+            time.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            return 200, {"ok": True, "result": []}
+        if method != "sendMessage":
+            return 200, {"ok": True, "result": True}
+        if self.rate_limit_prob and random.random() < self.rate_limit_prob:
+            self.rate_limited += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+            self.sent += 1
+        self.loop.call_soon_threadsafe(self._notify, chat_id, text)
+        return 200, {"ok": True, "result": {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": text,
+        }}
+
+    def _notify(self, chat_id: int, text: str):
+        fut = self.waiters.pop(chat_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(text)
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        fut = self.loop.create_future()
+        self.waiters[chat_id] = fut
+        return fut
+
+    def close(self):
+        self.server.shutdown()
+
+# -----------------------------
+# Generador de carga
+# -----------------------------
+@dataclass
+class LevelResult:
+    concurrency: int
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    timeouts: int = 0
+    pending_samples: List[int] = field(default_factory=list)
+    queue_samples: List[int] = field(default_factory=list)
+    elapsed: float = 0.0
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+class LoadGenerator:
+    def __init__(self, app, api: MockBotAPI, fast_ratio: float, reply_timeout: float, think_time: float):
+        self.app = app
+        self.api = api
+        self.fast_ratio = fast_ratio
+        self.reply_timeout = reply_timeout
+        self.think_time = think_time
+        self._update_id = 0
+        self.pending = 0
+
+    def _make_update(self, chat_id: int, text: str) -> Update:
+        self._update_id += 1
+        data = {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"Estudiante {chat_id}"},
+                "text": text,
+            },
+        }
+        return Update.de_json(data, self.app.bot)
+
+    async def _student(self, chat_id: int, stop_at: float, result: LevelResult):
+        rng = random.Random(chat_id)
+        while time.monotonic() < stop_at:
+            text = rng.choice(FAST_PATH) if rng.random() < self.fast_ratio else rng.choice(QUESTIONS)
+            reply = self.api.expect_reply(chat_id)
+            started = time.monotonic()
+            self.pending += 1
+            await self.app.update_queue.put(self._make_update(chat_id, text))
+            try:
+                answer = await asyncio.wait_for(reply, self.reply_timeout)
+                if answer == main.DEADLINE_REPLY:
+                    # Plazo vencido en el bot: no es una respuesta servida
+                    result.timeouts += 1
+                else:
+                    result.latencies.append(time.monotonic() - started)
+                    if answer.startswith("Error"):
+                        result.errors += 1
+            except asyncio.TimeoutError:
+                result.timeouts += 1
+                self.api.waiters.pop(chat_id, None)
+            finally:
+                self.pending -= 1
+            if self.think_time:
+                await asyncio.sleep(rng.expovariate(1.0 / self.think_time))
+
+    async def _sample(self, result: LevelResult, stop: asyncio.Event):
+        while not stop.is_set():
+            result.pending_samples.append(self.pending)
+            dispatcher = sender._DISPATCHER
+            result.queue_samples.append(self.app.update_queue.qsize() + (dispatcher.queue_size() if dispatcher else 0))
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_level(self, concurrency: int, duration: float, chat_offset: int) -> LevelResult:
+        result = LevelResult(concurrency=concurrency)
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(self._sample(result, stop))
+        started = time.monotonic()
+        stop_at = started + duration
+        await asyncio.gather(*[self._student(chat_offset + i, stop_at, result) for i in range(concurrency)])
+        result.elapsed = time.monotonic() - started
+        stop.set()
+        await sampler
+        return result
+
+def format_result(r: LevelResult) -> str:
+    done = len(r.latencies)
+    total = done + r.timeouts
+    # Crecimiento de la cola entre la mitad y el final del nivel (descarta el arranque)
+    growth = (r.queue_samples[-1] - r.queue_samples[len(r.queue_samples) // 2]) if r.queue_samples else 0
+    return (
+        f"{r.concurrency:>6} {done / r.elapsed:>8.2f} {percentile(r.latencies, 50):>7.2f} "
+        f"{percentile(r.latencies, 95):>7.2f} {percentile(r.latencies, 99):>7.2f} "
+        f"{max(r.pending_samples, default=0):>8} {max(r.queue_samples, default=0):>6} {growth:>+7} "
+        f"{(r.errors + r.timeouts) / max(1, total) * 100:>6.1f}%"
+    )
+
+async def run(args):
+    lm = start_mock_lm(MockLMConfig(
+        latency=args.lm_latency, prefill_tps=args.lm_prefill_tps, tps=args.lm_tps,
+        answer_tokens=args.lm_answer_tokens, slots=args.lm_slots,
+    ))
+    main.LMSTUDIO_URL = f"http://127.0.0.1:{lm.server_address[1]}/v1/chat/completions"
+    if main.KB is None:
+        main.set_kb(main.build_kb_from_pdf(args.pdf))
+
+    api = MockBotAPI(asyncio.get_running_loop(), rate_limit_prob=args.tg_429)
+    app = (
+        main.ApplicationBuilder()
+        .token("123456:LOADTEST")
+        .base_url(api.base_url)
+        .concurrent_updates(args.max_concurrent_updates)
+        .build()
+    )
+    app.add_handler(main.MessageHandler(main.filters.TEXT & (~main.filters.COMMAND), main.ask))
+
+    print(f"{'conc':>6} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'pending':>8} {'colas':>6} {'crec.':>7} {'error':>7}")
+    async with app:
+        await app.start()
+        try:
+            gen = LoadGenerator(app, api, args.fast_ratio, args.reply_timeout, args.think_time)
+            for n, level in enumerate(args.levels):
+                result = await gen.run_level(level, args.duration, chat_offset=(n + 1) * 100000)
+                print(format_result(result), flush=True)
+        finally:
+            dispatcher = sender._DISPATCHER
+            await app.stop()
+            await sender.shutdown_dispatcher()
+    print(f"Bot API: {api.sent} mensajes enviados, {api.rate_limited} respuestas 429 simuladas.")
+    if dispatcher is not None:
+        print(dispatcher.stats.describe())
+    print(main.RETRIEVAL_CACHE.describe())
+    api.close()
+    lm.shutdown()
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Prueba de carga del bot con LM y Telegram simulados.")
+    parser.add_argument("--pdf", default=main.PDF_PATH)
+    parser.add_argument("--levels", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=20.0, help="segundos por nivel de concurrencia")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pausa media entre preguntas de un estudiante")
+    parser.add_argument("--fast-ratio", type=float, default=0.1, help="fracción de saludos/agradecimientos")
+    parser.add_argument("--reply-timeout", type=float, default=120.0)
+    parser.add_argument("--max-concurrent-updates", type=int, default=256)
+    parser.add_argument("--lm-latency", type=float, default=0.2)
+    parser.add_argument("--lm-prefill-tps", type=float, default=2000.0)
+    parser.add_argument("--lm-tps", type=float, default=40.0)
+    parser.add_argument("--lm-answer-tokens", type=int, default=150)
+    parser.add_argument("--lm-slots", type=int, default=1)
+    parser.add_argument("--tg-429", type=float, default=0.0, help="probabilidad de responder 429 en sendMessage")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger("uni-bot").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,23 +1,44 @@
 import os
 import re
+import json
+import socket
+import hashlib
+import pickle
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import time
-from dataclasses import dataclass
-from typing import List, Tuple
+import html
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, List, Tuple
 import asyncio
+import itertools
 
-from telegram import Update
+from telegram import ReplyParameters, Update
 from telegram.constants import ParseMode
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.neighbors import NearestNeighbors
+import numpy as np
+import scipy.sparse as sp
 import PyPDF2
 import nltk
 from nltk.corpus import stopwords
 
+import db
+import sender
+import profiling
+from dedup import DedupStats, dedupe_chunks
+from cancellation import (
+    CancelToken, RequestCancelled, cancel_all_requests, register_request, request_key, run_cancellable, unregister_request,
+)
+from kb_store import KB_CACHE_MAX_MB, KBStore
+from retrieval_cache import RETRIEVAL_CACHE_SIZE, CachedRetrieval, LRUCache
+from vectorizers import HashingTfidfVectorizer
+
 # -----------------------------
 # Configuración
 # -----------------------------
@@ -35,9 +56,47 @@ SYSTEM_PROMPT = (
 # Permitir fallback a conocimiento general cuando el PDF no sea suficiente
 ALLOW_GENERAL_FALLBACK = os.getenv("ALLOW_GENERAL_FALLBACK", "1") not in ("0", "false", "False")
 
+# Plazo extremo a extremo de una pregunta (segundos): al vencer se corta la generación en curso
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "120"))
+DEADLINE_REPLY = "La respuesta tardó demasiado. Intenta de nuevo en unos momentos."
+# Updates procesados en paralelo (permite que una pregunta nueva reemplace a la anterior del mismo chat)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+# IDs de usuario o chat autorizados para comandos de administración (separados por comas)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.lstrip("-").isdigit()}
+
 # Umbral mínimo de similitud
 MIN_CONTEXT_SCORE = 0.05
 
+# Vectorización: "tfidf" (vocabulario explícito, se reajusta al añadir texto) o
+# "hashing" (dimensión fija, memoria acotada y fragmentos añadibles sin reajuste)
+VECTORIZER_MODE = os.getenv("VECTORIZER_MODE", "tfidf")
+
+# Ingesta en streaming: fragmentos por lote vectorizado y cada cuántas páginas informar progreso
+INGEST_BATCH_CHUNKS = int(os.getenv("INGEST_BATCH_CHUNKS", "256"))
+INGEST_LOG_EVERY_PAGES = int(os.getenv("INGEST_LOG_EVERY_PAGES", "50"))
+# Fusionar fragmentos casi idénticos (cabeceras, pies, secciones repetidas) al indexar
+DEDUP_CHUNKS = os.getenv("DEDUP_CHUNKS", "1") not in ("0", "false", "False")
+
+# Recuperación en dos etapas: candidatos de la primera pasada y máximo de fragmentos finales
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "30"))
+RETRIEVAL_MAX_K = int(os.getenv("RETRIEVAL_MAX_K", "5"))
+# Corte adaptativo: descartar fragmentos por debajo de esta fracción del mejor puntaje
+# y cortar en el primer salto relativo de puntaje mayor que RERANK_SCORE_GAP
+RERANK_MIN_RATIO = float(os.getenv("RERANK_MIN_RATIO", "0.75"))
+RERANK_SCORE_GAP = float(os.getenv("RERANK_SCORE_GAP", "0.15"))
+
+# Compresión extractiva del contexto: solo las oraciones más afines a la pregunta llegan al
+# modelo (el prefill domina la latencia). Máximo de oraciones en total y palabras por oración
+PROMPT_COMPRESSION = os.getenv("PROMPT_COMPRESSION", "1") not in ("0", "false", "False")
+COMPRESS_MAX_SENTENCES = int(os.getenv("COMPRESS_MAX_SENTENCES", "8"))
+COMPRESS_SENTENCE_WORDS = int(os.getenv("COMPRESS_SENTENCE_WORDS", "60"))
+
+# Documentos por chat: las rutas relativas de /documentos se resuelven contra DOCS_DIR y
+# los índices construidos se guardan en INDEX_DIR para no reconstruirlos al reiniciar
+DOCS_DIR = os.getenv("DOCS_DIR", os.path.dirname(os.path.abspath(__file__)))
+INDEX_DIR = os.getenv("INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes"))
+
 # -----------------------------
 # Logging
 # -----------------------------
@@ -65,89 +124,467 @@ GREETINGS = {"hola", "holaa", "buenas", "buenos dias", "buenos días", "saludos"
 THANKS = {"gracias", "muchas gracias", "mil gracias", "thank you", "thanks"}
 BYE = {"chao", "adios", "adiós", "hasta luego", "nos vemos", "bye"}
 
+_WORD_RE = re.compile(r"\w+")
+
 def normalize(text: str) -> str:
     return re.sub(r"\s+", " ", text.lower()).strip()
 
+def normalize_query(text: str) -> str:
+    """Clave de caché: el vectorizador ignora mayúsculas y puntuación, así que dos consultas
+    con la misma normalización producen el mismo vector."""
+    return " ".join(_WORD_RE.findall(text.lower()))
+
 def is_exact_match(text: str, phrases: set) -> bool:
     return normalize(text) in phrases
 
 # -----------------------------
 # Utilidades PDF y texto
 # -----------------------------
-def read_pdf_text(path: str) -> str:
+def iter_pdf_pages(path: str, progress: Callable[[int, int], None] = None, label: str = None) -> Iterator[str]:
+    """Genera el texto normalizado de cada página sin acumular el documento completo.
+    Con `label` la marca de página incluye el documento: "[apuntes.pdf | Página N]"."""
     reader = PyPDF2.PdfReader(path)
-    texts = []
-    for i, page in enumerate(reader.pages):
+    total = len(reader.pages)
+    for i in range(total):
         try:
-            t = page.extract_text() or ""
+            t = reader.pages[i].extract_text() or ""
             t = re.sub(r"\s+", " ", t).strip()
             if t:
-                texts.append(f"[Página {i+1}] {t}")
+                yield f"[{label} | Página {i+1}] {t}" if label else f"[Página {i+1}] {t}"
         except Exception as e:
             logger.warning(f"Error leyendo página {i+1}: {e}")
-    return "\n\n".join(texts)
+        if progress is not None:
+            progress(i + 1, total)
+
+def read_pdf_text(path: str) -> str:
+    return "\n\n".join(iter_pdf_pages(path))
+
+_PAGE_TAG_RE = re.compile(r"^\[([^\[\]]+)\] ")
+
+def iter_chunks_with_pages(texts: Iterable[str], max_tokens: int = 1600, overlap: int = 100) -> Iterator[Tuple[str, List[str]]]:
+    """Como `iter_chunks`, pero cada fragmento va con las páginas que abarca, tomadas de
+    la marca inicial de cada texto ("Página 3" o "a.pdf | Página 3")."""
+    step = max_tokens - overlap
+    buf: List[str] = []
+    owners: List[int] = []  # índice en `labels` del texto del que viene cada palabra
+    labels: List[str] = []
+
+    def pages_of(n: int) -> List[str]:
+        return [labels[i] for i in range(owners[0], owners[n - 1] + 1) if labels[i]]
+
+    for text in texts:
+        m = _PAGE_TAG_RE.match(text)
+        labels.append(m.group(1) if m else None)
+        words = text.split()
+        buf.extend(words)
+        owners.extend([len(labels) - 1] * len(words))
+        while len(buf) >= max_tokens:
+            yield " ".join(buf[:max_tokens]), pages_of(max_tokens)
+            del buf[:step]
+            del owners[:step]
+    if buf:
+        yield " ".join(buf), pages_of(len(buf))
+
+def iter_chunks(texts: Iterable[str], max_tokens: int = 1600, overlap: int = 100) -> Iterator[str]:
+    """Ventana deslizante de palabras sobre un flujo de textos; produce los mismos
+    fragmentos que `chunk_text` sobre el texto concatenado."""
+    for chunk, _ in iter_chunks_with_pages(texts, max_tokens=max_tokens, overlap=overlap):
+        yield chunk
 
 def chunk_text(text: str, max_tokens: int = 1600, overlap: int = 100) -> List[str]:
-    words = text.split()
-    chunk_size = max_tokens
-    chunks = []
-    i = 0
-    while i < len(words):
-        chunk = " ".join(words[i:i+chunk_size])
-        chunks.append(chunk)
-        i += chunk_size - overlap
-    return chunks
+    return list(iter_chunks([text], max_tokens=max_tokens, overlap=overlap))
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Versión única por KB construida o modificada; forma parte de la clave de la caché de recuperación
+_KB_VERSIONS = itertools.count(1)
 
 @dataclass
 class KnowledgeBase:
     chunks: List[str]
-    vectorizer: TfidfVectorizer
+    vectorizer: any  # TfidfVectorizer o HashingTfidfVectorizer
     matrix: any
     nn: any = None
+    counts: any = None  # conteos crudos por fragmento (solo modo hashing)
+    source: dict = None  # huella del PDF de origen (ver pdf_fingerprint)
+    pages: List[List[str]] = None  # páginas de origen de cada fragmento, incluidas las de sus duplicados
+    version: int = field(default_factory=lambda: next(_KB_VERSIONS))
 
-def build_kb_from_pdf(pdf_path: str) -> KnowledgeBase:
-    full_text = read_pdf_text(pdf_path)
-    if not full_text:
-        raise ValueError("No se pudo extraer texto del PDF. Verifica el archivo.")
-    chunks = chunk_text(full_text, max_tokens=400, overlap=100)
-
+def make_vectorizer(mode: str = None):
+    mode = mode or VECTORIZER_MODE
     spanish_stopwords = stopwords.words("spanish")
-    vectorizer = TfidfVectorizer(
+    if mode == "hashing":
+        return HashingTfidfVectorizer(stop_words=spanish_stopwords, ngram_range=(1, 2), max_df=0.9)
+    if mode != "tfidf":
+        raise ValueError(f"VECTORIZER_MODE desconocido: {mode}")
+    return TfidfVectorizer(
         lowercase=True,
         stop_words=spanish_stopwords,
         ngram_range=(1, 2),
         max_df=0.9,
         min_df=1,
     )
-    matrix = vectorizer.fit_transform(chunks)
+
+def _fit_nn(matrix):
     # Pre-ajustar un NearestNeighbors para búsquedas rápidas (cosine)
     try:
         nn = NearestNeighbors(n_neighbors=10, metric="cosine", algorithm="brute")
         nn.fit(matrix)
     except Exception:
         nn = None
-    logger.info(f"KB creada con {len(chunks)} fragmentos.")
-    return KnowledgeBase(chunks=chunks, vectorizer=vectorizer, matrix=matrix, nn=nn)
+    return nn
 
-def retrieve_context(kb: KnowledgeBase, query: str, k: int = 5) -> List[Tuple[int, str, float]]:
-    q_vec = kb.vectorizer.transform([query])
+def build_kb_from_chunks(chunks: Iterable[str], mode: str = None) -> KnowledgeBase:
+    """Construye la KB consumiendo `chunks` por lotes. En modo hashing cada lote se
+    vectoriza al llegar; TfidfVectorizer necesita todos los fragmentos para ajustarse."""
+    vectorizer = make_vectorizer(mode)
+    incremental = isinstance(vectorizer, HashingTfidfVectorizer)
+    all_chunks: List[str] = []
+    count_batches = []
+    for batch in _batched(chunks, INGEST_BATCH_CHUNKS):
+        all_chunks.extend(batch)
+        if incremental:
+            count_batches.append(vectorizer.partial_fit(batch))
+    if not all_chunks:
+        raise ValueError("No se pudo extraer texto del PDF. Verifica el archivo.")
+
+    counts = None
+    if incremental:
+        counts = sp.vstack(count_batches, format="csr")
+        matrix = vectorizer.weight(counts)
+    else:
+        matrix = vectorizer.fit_transform(all_chunks)
+    return KnowledgeBase(chunks=all_chunks, vectorizer=vectorizer, matrix=matrix, nn=_fit_nn(matrix), counts=counts)
+
+def build_kb_from_pdf(pdf_path: str, mode: str = None, progress: Callable[[int, int], None] = None) -> KnowledgeBase:
+    """Pipeline página → normalización → fragmentos → vectorización, sin materializar el texto completo.
+    `progress(páginas_leídas, total)` permite a la GUI seguir el avance."""
+    return build_kb_from_pdfs([pdf_path], mode=mode, progress=progress)
+
+def build_kb_from_pdfs(pdf_paths: List[str], mode: str = None, progress: Callable[[int, int], None] = None,
+                       dedup: bool = None) -> KnowledgeBase:
+    """Igual que `build_kb_from_pdf` sobre varios PDFs encadenados en un solo índice.
+    Con más de un documento cada marca de página indica de qué PDF viene.
+    Con `dedup` (por defecto DEDUP_CHUNKS) los fragmentos casi idénticos se fusionan en
+    uno que conserva las páginas de todos."""
+    dedup = DEDUP_CHUNKS if dedup is None else dedup
+    def on_page(done: int, total: int):
+        if done % INGEST_LOG_EVERY_PAGES == 0 or done == total:
+            logger.info(f"Ingesta: {done}/{total} páginas procesadas.")
+        if progress is not None:
+            progress(done, total)
+
+    multi = len(pdf_paths) > 1
+    with profiling.trace_allocations("build_kb_from_pdf"):
+        pages = itertools.chain.from_iterable(
+            iter_pdf_pages(path, progress=on_page, label=os.path.basename(path) if multi else None)
+            for path in pdf_paths
+        )
+        items = iter_chunks_with_pages(pages, max_tokens=400, overlap=100)
+        stats = DedupStats()
+        if dedup:
+            items = dedupe_chunks(items, stats=stats)
+        provenance: List[List[str]] = []
+
+        def chunk_texts() -> Iterator[str]:
+            for chunk, chunk_pages in items:
+                # La lista puede crecer después si aparecen duplicados de este fragmento
+                provenance.append(chunk_pages)
+                yield chunk
+
+        kb = build_kb_from_chunks(chunk_texts(), mode)
+    kb.pages = provenance
+    kb.source = documents_fingerprint(pdf_paths)
+    if dedup:
+        logger.info(stats.describe())
+    logger.info(f"KB creada con {len(kb.chunks)} fragmentos.")
+    return kb
+
+def append_to_kb(kb: KnowledgeBase, new_chunks: List[str]) -> KnowledgeBase:
+    """Añade fragmentos a la KB. En modo hashing solo se vectorizan los nuevos y se
+    reponderan los conteos existentes; con TfidfVectorizer se reajusta todo."""
+    if not new_chunks:
+        return kb
+    if isinstance(kb.vectorizer, HashingTfidfVectorizer):
+        new_counts = kb.vectorizer.partial_fit(new_chunks)
+        kb.counts = sp.vstack([kb.counts, new_counts], format="csr")
+        kb.matrix = kb.vectorizer.weight(kb.counts)
+    else:
+        kb.matrix = kb.vectorizer.fit_transform(kb.chunks + list(new_chunks))
+    kb.chunks.extend(new_chunks)
+    if kb.pages is not None:
+        kb.pages.extend([] for _ in new_chunks)
+    kb.nn = _fit_nn(kb.matrix)
+    # Nueva versión: las entradas de caché de la versión anterior dejan de usarse
+    kb.version = next(_KB_VERSIONS)
+    return kb
+
+# -----------------------------
+# Persistencia del índice
+# -----------------------------
+INDEX_FORMAT_VERSION = 1
+
+def pdf_fingerprint(path: str) -> dict:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"path": os.path.abspath(path), "size": os.path.getsize(path), "sha256": digest.hexdigest()}
+
+def documents_fingerprint(paths: List[str]) -> dict:
+    """Huella de un PDF o, para varios, {"documents": [huella, ...]}."""
+    if len(paths) == 1:
+        return pdf_fingerprint(paths[0])
+    return {"documents": [pdf_fingerprint(p) for p in paths]}
+
+def source_documents(source: dict) -> List[dict]:
+    if not source:
+        return []
+    return source.get("documents", [source])
+
+def save_kb(kb: KnowledgeBase, path: str, source_pdf: str = None) -> None:
+    """Guarda el índice con pickle (solo cargar índices propios y de confianza).
+    NearestNeighbors no se guarda: se reajusta al cargar."""
+    data = {
+        "format": INDEX_FORMAT_VERSION,
+        "source": pdf_fingerprint(source_pdf) if source_pdf else kb.source,
+        "chunks": kb.chunks,
+        "vectorizer": kb.vectorizer,
+        "matrix": kb.matrix,
+        "counts": kb.counts,
+        "pages": kb.pages,
+    }
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    logger.info(f"Índice guardado en {path} ({len(kb.chunks)} fragmentos).")
+
+def load_kb(path: str) -> KnowledgeBase:
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict) or data.get("format") != INDEX_FORMAT_VERSION:
+        raise ValueError(f"Formato de índice no compatible: {path}")
+    kb = KnowledgeBase(
+        chunks=data["chunks"],
+        vectorizer=data["vectorizer"],
+        matrix=data["matrix"],
+        nn=_fit_nn(data["matrix"]),
+        counts=data.get("counts"),
+        source=data.get("source"),
+        pages=data.get("pages"),
+    )
+    logger.info(f"Índice cargado desde {path} ({len(kb.chunks)} fragmentos).")
+    return kb
+
+# -----------------------------
+# KBs por conjunto de documentos
+# -----------------------------
+def document_set_key(paths: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sorted({os.path.abspath(p) for p in paths}))
+
+def _index_path_for(key: Tuple[str, ...], mode: str) -> str:
+    options = (mode, "dedup" if DEDUP_CHUNKS else "")
+    digest = hashlib.sha1("\n".join(key + options).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(INDEX_DIR, f"{digest}.idx")
+
+def _index_is_current(kb: KnowledgeBase, key: Tuple[str, ...]) -> bool:
+    docs = source_documents(kb.source)
+    if sorted(d.get("path") for d in docs) != list(key):
+        return False
+    return all(pdf_fingerprint(d["path"])["sha256"] == d.get("sha256") for d in docs)
+
+def load_or_build_kb(key: Tuple[str, ...]) -> KnowledgeBase:
+    """Carga el índice guardado del conjunto de documentos si sigue vigente; si no, lo
+    construye desde los PDFs y lo guarda para la próxima vez."""
+    missing = [p for p in key if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"No se encuentra: {', '.join(missing)}")
+    index_path = _index_path_for(key, VECTORIZER_MODE)
+    if os.path.exists(index_path):
+        try:
+            kb = load_kb(index_path)
+            if _index_is_current(kb, key):
+                return kb
+            logger.info(f"Índice {index_path} desactualizado; se reconstruye.")
+        except Exception:
+            logger.exception(f"No se pudo cargar {index_path}; se reconstruye.")
+    kb = build_kb_from_pdfs(list(key))
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        save_kb(kb, index_path)
+    except Exception:
+        # No es crítico: la KB ya está en memoria
+        logger.exception(f"No se pudo guardar el índice en {index_path}")
+    return kb
+
+KB_STORE = KBStore(load_or_build_kb, int(KB_CACHE_MAX_MB * 2**20))
+
+# Vectores de consulta y top-k por (versión de KB, consulta normalizada)
+RETRIEVAL_CACHE = LRUCache(RETRIEVAL_CACHE_SIZE, name="Caché de recuperación")
+
+def _nearest(kb: KnowledgeBase, q_vec, k: int) -> List[Tuple[int, float]]:
     if kb.nn is not None:
         # NearestNeighbors returns distances (cosine distance), convert to similarity
         try:
             dists, idxs = kb.nn.kneighbors(q_vec, n_neighbors=min(k, kb.matrix.shape[0]))
-            dists = dists.flatten()
-            idxs = idxs.flatten()
-            sims = [1.0 - float(d) for d in dists]
-            results = [(int(idx), kb.chunks[int(idx)], float(sim)) for idx, sim in zip(idxs, sims)]
-            return results
+            return [(int(idx), 1.0 - float(d)) for idx, d in zip(idxs.flatten(), dists.flatten())]
         except Exception:
             pass
 
     sims = cosine_similarity(q_vec, kb.matrix).flatten()
     top_idx = sims.argsort()[::-1][:k]
-    results = [(int(i), kb.chunks[int(i)], float(sims[int(i)])) for i in top_idx]
+    return [(int(i), float(sims[int(i)])) for i in top_idx]
+
+def retrieve_context(kb: KnowledgeBase, query: str, k: int = 5) -> List[Tuple[int, str, float]]:
+    key = (kb.version, normalize_query(query))
+    cached = RETRIEVAL_CACHE.get(key)
+    if cached is not None and cached.k >= k:
+        top = cached.top[:k]
+    else:
+        q_vec = cached.q_vec if cached is not None else kb.vectorizer.transform([query])
+        top = _nearest(kb, q_vec, k)
+        RETRIEVAL_CACHE.put(key, CachedRetrieval(q_vec=q_vec, k=k, top=top))
+    return [(idx, kb.chunks[idx], score) for idx, score in top]
+
+def _query_terms(kb: KnowledgeBase, query: str) -> List[str]:
+    stop = kb.vectorizer.get_stop_words() or frozenset()
+    terms = []
+    for t in _WORD_RE.findall(query.lower()):
+        if len(t) > 1 and t not in stop and t not in terms:
+            terms.append(t)
+    return terms
+
+def _min_window(positions: dict) -> int:
+    """Longitud de la ventana más corta que contiene todos los términos de `positions`."""
+    events = sorted((pos, term) for term, plist in positions.items() for pos in plist)
+    need = len(positions)
+    counts = {}
+    best = None
+    left = 0
+    for right_pos, term in events:
+        counts[term] = counts.get(term, 0) + 1
+        while len(counts) == need:
+            left_pos, left_term = events[left]
+            span = right_pos - left_pos + 1
+            if best is None or span < best:
+                best = span
+            counts[left_term] -= 1
+            if counts[left_term] == 0:
+                del counts[left_term]
+            left += 1
+    return best or 1
+
+def _rerank_score(terms: List[str], chunk: str, sim: float, top_sim: float) -> float:
+    if not terms:
+        return sim / top_sim
+    term_set = set(terms)
+    positions = {}
+    for pos, w in enumerate(_WORD_RE.findall(chunk.lower())):
+        if w in term_set:
+            positions.setdefault(w, []).append(pos)
+    if not positions:
+        return 0.6 * sim / top_sim
+    coverage = len(positions) / len(terms)
+    proximity = len(positions) / _min_window(positions)
+    return 0.6 * sim / top_sim + 0.25 * coverage + 0.15 * coverage * proximity
+
+def rerank_contexts(kb: KnowledgeBase, query: str, candidates: List[Tuple[int, str, float]],
+                    max_k: int = RETRIEVAL_MAX_K) -> List[Tuple[int, str, float]]:
+    """Segunda etapa: reordena los candidatos por cobertura y proximidad de los términos
+    de la consulta y corta adaptativamente en el salto de puntaje. Las tuplas devueltas
+    conservan la similitud coseno de la primera etapa (la que se muestra como score); el
+    puntaje compuesto solo decide el orden y el corte."""
+    candidates = [c for c in candidates if c[2] > 0]
+    if not candidates:
+        return []
+    top_sim = max(score for _, _, score in candidates)
+    terms = _query_terms(kb, query)
+    scored = [(_rerank_score(terms, chunk, sim, top_sim), (idx, chunk, sim)) for idx, chunk, sim in candidates]
+    scored.sort(key=lambda r: r[0], reverse=True)
+    scored = scored[:max_k]
+
+    best = scored[0][0]
+    results = [scored[0][1]]
+    for (prev, _), (cur, context) in zip(scored, scored[1:]):
+        if cur < best * RERANK_MIN_RATIO:
+            break
+        if prev > 0 and (prev - cur) / prev > RERANK_SCORE_GAP:
+            break
+        results.append(context)
     return results
 
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+|\s+(?=\[(?:[^\[\]|]+ \| )?Página \d+\])")
+
+def split_sentences(text: str, max_words: int = COMPRESS_SENTENCE_WORDS) -> List[str]:
+    """Oraciones del fragmento; las marcas de página también cortan y las "oraciones" sin
+    puntuación (tablas, listas) se parten en trozos de `max_words` palabras."""
+    sentences = []
+    for part in _SENTENCE_END_RE.split(text):
+        words = part.split()
+        for i in range(0, len(words), max_words):
+            sentences.append(" ".join(words[i:i + max_words]))
+    return sentences
+
+def compress_contexts(kb: KnowledgeBase, query: str, contexts: List[Tuple[int, str, float]],
+                      max_sentences: int = COMPRESS_MAX_SENTENCES) -> List[Tuple[int, str, float]]:
+    """Reduce cada fragmento a sus oraciones más afines a la consulta (similitud con el
+    vectorizador de la KB más cobertura de términos). Se conserva la mejor oración de cada
+    fragmento y el resto del cupo va a las mejores en conjunto; dentro de un fragmento
+    mantienen su orden y " … " marca el texto omitido."""
+    if not contexts:
+        return contexts
+    spans = []
+    sentences: List[str] = []
+    for _, chunk, _ in contexts:
+        parts = split_sentences(chunk)
+        spans.append((len(sentences), len(sentences) + len(parts)))
+        sentences.extend(parts)
+    if len(sentences) <= max_sentences:
+        return contexts
+
+    q_vec = kb.vectorizer.transform([query])
+    sims = (kb.vectorizer.transform(sentences) @ q_vec.T).toarray().ravel()
+    terms = set(_query_terms(kb, query))
+    if terms:
+        coverage = [len(terms.intersection(_WORD_RE.findall(sent.lower()))) / len(terms) for sent in sentences]
+        sims = sims + 0.2 * np.asarray(coverage)
+    # Las ventanas se solapan: una oración repetida en otro fragmento no vuelve a ocupar cupo
+    seen = set()
+    for i, sent in enumerate(sentences):
+        if sent in seen:
+            sims[i] = -1.0
+        seen.add(sent)
+
+    keep = set()
+    for start, end in spans:
+        if end > start:
+            keep.add(start + int(np.argmax(sims[start:end])))
+    for i in np.argsort(-sims, kind="stable"):
+        if len(keep) >= max(max_sentences, len(spans)):
+            break
+        keep.add(int(i))
+
+    compressed = []
+    for (idx, _, score), (start, end) in zip(contexts, spans):
+        chosen = [i for i in range(start, end) if i in keep]
+        text = ""
+        for prev, i in zip([None] + chosen, chosen):
+            gap = (prev is None and i > start) or (prev is not None and i > prev + 1)
+            text += (" … " if gap else " ") + sentences[i]
+        if chosen and chosen[-1] < end - 1:
+            text += " …"
+        compressed.append((idx, text.strip(), score))
+    return compressed
+
 def build_prompt(contexts: List[Tuple[int, str, float]], question: str, limit_chars: int = 3000) -> List[dict]:
     context_texts = []
     total = 0
@@ -175,34 +612,198 @@ def build_prompt(contexts: List[Tuple[int, str, float]], question: str, limit_ch
     ]
     return messages
 
-def call_lmstudio(messages: List[dict], temperature: float = 0.3, max_tokens: int = 300) -> str:
+class _AbortableAdapter(HTTPAdapter):
+    """Adaptador que guarda el socket de cada conexión en cuanto se abre, para poder cortarla
+    desde otro hilo aunque el servidor aún no haya enviado las cabeceras (petición en cola o
+    en prefill). `shutdown` despierta al hilo bloqueado leyendo, que falla y libera el hilo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets: list = []
+        self._aborted = False
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._tracking_pool(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _tracking_pool(self, pool_cls):
+        track = self._track
+
+        class Connection(pool_cls.ConnectionCls):
+            def connect(self):
+                super().connect()
+                track(self.sock)
+
+        return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": Connection})
+
+    def _track(self, sock) -> None:
+        with self._lock:
+            self._sockets.append(sock)
+            aborted = self._aborted
+        if aborted:
+            self._shutdown(sock)
+
+    def abort(self) -> None:
+        with self._lock:
+            self._aborted = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            self._shutdown(sock)
+
+    @staticmethod
+    def _shutdown(sock) -> None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _post_lmstudio(payload: dict, read_timeout: float, token: CancelToken = None) -> str:
+    with requests.Session() as session:
+        adapter = _AbortableAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        unregister = token.on_cancel(adapter.abort) if token is not None else None
+        try:
+            resp = session.post(LMSTUDIO_URL, json=payload, timeout=(min(10, read_timeout), read_timeout), stream=True)
+        except BaseException:
+            if unregister is not None:
+                unregister()
+            raise
+        try:
+            resp.raise_for_status()
+            if "text/event-stream" not in resp.headers.get("Content-Type", ""):
+                data = resp.json()
+                return data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+            # Respuesta en streaming (SSE): permite cortar la generación entre tokens. Con el
+            # chunk_size por defecto (512) se acumulan varios eventos antes de cada comprobación
+            parts = []
+            for raw in resp.iter_lines(chunk_size=1):
+                if token is not None:
+                    token.check()
+                line = raw.decode("utf-8", errors="replace").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data).get("choices", [{}])[0].get("delta", {})
+                parts.append(delta.get("content") or "")
+            if token is not None:
+                # Al cortar el socket el stream puede terminar como un EOF normal: no
+                # devolver una respuesta a medias de una petición cancelada
+                token.check()
+            return "".join(parts).strip()
+        finally:
+            if unregister is not None:
+                unregister()
+            resp.close()
+
+def call_lmstudio(messages: List[dict], temperature: float = 0.3, max_tokens: int = 300, token: CancelToken = None) -> str:
     payload = {
         "model": LM_MODEL_NAME,
         "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens,
         "top_p": 0.9,
-        "stream": False
+        "stream": True
     }
     # Timeout configurable via env var LMSTUDIO_TIMEOUT (seconds)
     timeout = int(os.getenv("LMSTUDIO_TIMEOUT", "60"))
     attempts = 3
     for attempt in range(1, attempts + 1):
+        read_timeout = timeout
+        if token is not None:
+            token.check()
+            remaining = token.remaining()
+            if remaining is not None:
+                read_timeout = max(0.1, min(timeout, remaining))
         try:
-            resp = requests.post(LMSTUDIO_URL, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            data = resp.json()
-            return data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+            return _post_lmstudio(payload, read_timeout, token)
         except requests.exceptions.ReadTimeout as e:
+            if token is not None and (token.cancelled or token.expired):
+                token.check()
             logger.exception(f"Timeout connecting to LM Studio (attempt {attempt}/{attempts}): {e}")
             if attempt == attempts:
                 raise
-            time.sleep(1 * attempt)
+            if token is None:
+                time.sleep(1 * attempt)
+            elif token.wait(1 * attempt):
+                token.check()
         except requests.exceptions.RequestException as e:
+            if token is not None and (token.cancelled or token.expired):
+                # La conexión se cortó a propósito al cancelar, o el stream se detuvo y el
+                # timeout de lectura (acotado al plazo) saltó como ConnectionError
+                if not token.cancelled:
+                    token.cancel("plazo vencido")
+                raise RequestCancelled(token.reason) from e
             logger.exception(f"Request error calling LM Studio: {e}")
             # For non-timeout request errors, don't retry many times
             raise
 
+# -----------------------------
+# Pipeline de respuesta (compartido por el bot y la CLI)
+# -----------------------------
+def prepare_messages(kb: KnowledgeBase, question: str) -> Tuple[List[dict], List[Tuple[int, str, float]]]:
+    # Recuperación basada en PDF: candidatos amplios y luego reordenamiento con corte adaptativo
+    candidates = retrieve_context(kb, question, k=RETRIEVAL_CANDIDATES)
+    max_score = max([score for _, _, score in candidates], default=0.0)
+    contexts = rerank_contexts(kb, question, candidates, max_k=RETRIEVAL_MAX_K)
+
+    # Decidir si permitimos fallback a conocimiento general
+    allow_fallback_now = ALLOW_GENERAL_FALLBACK and (max_score < MIN_CONTEXT_SCORE)
+    if max_score < MIN_CONTEXT_SCORE:
+        logger.info("Contexto débil detectado.")
+
+    if PROMPT_COMPRESSION:
+        contexts = compress_contexts(kb, question, contexts)
+    messages = build_prompt(contexts, question, limit_chars=7000)
+    if allow_fallback_now:
+        # permitir al modelo usar conocimiento general si el contexto no basta
+        messages[1]["content"] += (
+            "\n\nSi el contexto del documento no es suficiente, puedes responder usando conocimiento general. "
+            "Indica claramente cuando la respuesta proviene de fuera del documento."
+        )
+    return messages, contexts
+
+def truncate_answer(answer: str) -> str:
+    # longitud máxima de la respuesta en caracteres (configurable)
+    max_reply_chars = int(os.getenv("MAX_REPLY_CHARS", "1000"))
+    if answer and len(answer) > max_reply_chars:
+        # intentar cortar en el último punto para no romper frases
+        truncated = answer[:max_reply_chars]
+        if "." in truncated:
+            truncated = truncated.rsplit('.', 1)[0] + '.'
+        answer = truncated + "\n\n[Respuesta truncada por longitud]"
+    return answer
+
+@profiling.profiled("answer_question")
+def answer_question(kb: KnowledgeBase, question: str, token: CancelToken = None) -> Tuple[str, List[Tuple[int, str, float]]]:
+    """Recupera contexto, llama al modelo y devuelve (respuesta, fragmentos usados).
+    Con `token`, la llamada al modelo respeta su plazo y se corta si se cancela."""
+    messages, contexts = prepare_messages(kb, question)
+    if token is not None:
+        token.check()
+    answer = call_lmstudio(messages, temperature=0.3, max_tokens=300, token=token)
+    return truncate_answer(answer), contexts
+
+def _format_pages(pages: List[str], limit: int = 6) -> str:
+    shown = ", ".join(pages[:limit])
+    return shown + (f" y {len(pages) - limit} más" if len(pages) > limit else "")
+
+def format_references(contexts: List[Tuple[int, str, float]], kb: KnowledgeBase = None) -> str:
+    lines = []
+    for idx, _, score in contexts:
+        line = f"- Fragmento {idx} (score {score:.3f})"
+        pages = kb.pages[idx] if kb is not None and kb.pages else None
+        if pages:
+            line += f" · {html.escape(_format_pages(pages))}"
+        lines.append(line)
+    return "\n".join(lines) or "- Ninguna"
+
 # -----------------------------
 # Bot de Telegram
 # -----------------------------
@@ -214,13 +815,25 @@ from collections import deque
 _PROCESSED_DEQUE = deque(maxlen=2048)
 _PROCESSED_SET = set()
 
+async def send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, fast: bool = False, **kwargs):
+    """Responde a través de la cola de salida (límites de Telegram y división de mensajes largos).
+    En grupos la respuesta cita la pregunta y, en foros, queda en el mismo tema."""
+    chat = update.effective_chat
+    message = update.effective_message
+    if message is not None and chat.type != chat.PRIVATE:
+        kwargs.setdefault("reply_parameters", ReplyParameters(message.message_id, allow_sending_without_reply=True))
+        if message.is_topic_message and message.message_thread_id:
+            kwargs.setdefault("message_thread_id", message.message_thread_id)
+    dispatcher = sender.get_dispatcher(context.bot)
+    return await dispatcher.send(chat.id, text, fast=fast, **kwargs)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = "Bot académico cargado. Envía tu pregunta sobre la materia.\n"
     if ALLOW_GENERAL_FALLBACK:
         msg += "Puedo también intentar responder con conocimiento general si el PDF no contiene la información."
     else:
         msg += "Respondo únicamente con base en el documento."
-    await update.message.reply_text(msg)
+    await send_reply(update, context, msg, fast=True)
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
@@ -232,10 +845,113 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += "Si no está en el PDF, puedo intentar responder usando conocimiento general."
     else:
         msg += "Si no está en el PDF, te lo diré."
-    await update.message.reply_text(msg)
+    msg += "\nCon /documentos ves qué PDFs consulta este chat."
+    await send_reply(update, context, msg, fast=True)
 
-async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def is_admin(update: Update) -> bool:
+    user = update.effective_user
+    chat = update.effective_chat
+    return (user is not None and user.id in ADMIN_IDS) or (chat is not None and chat.id in ADMIN_IDS)
+
+async def profiling_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profiling on [fracción] | off | estado — solo administradores."""
+    if not is_admin(update):
+        await send_reply(update, context, "Comando reservado a administradores.", fast=True)
+        return
+    args = [a.lower() for a in (context.args or [])]
+    if args and args[0] in ("on", "activar"):
+        rate = None
+        if len(args) > 1:
+            try:
+                rate = float(args[1])
+            except ValueError:
+                await send_reply(update, context, "Uso: /profiling on [fracción entre 0 y 1]", fast=True)
+                return
+        profiling.STATE.set(True, rate)
+    elif args and args[0] in ("off", "desactivar"):
+        profiling.STATE.set(False)
+    await send_reply(update, context, profiling.STATE.describe(), fast=True)
+
+def _resolve_document_path(raw: str) -> str:
+    path = os.path.expanduser(raw.strip().strip('"'))
+    if not os.path.isabs(path):
+        path = os.path.join(DOCS_DIR, path)
+    return os.path.abspath(path)
+
+# Documentos asignados por chat, en memoria: se leen de la DB una vez al arrancar y
+# /documentos los actualiza, así las preguntas no tocan sqlite
+_CHAT_DOCUMENTS: dict = None
+
+def load_chat_documents() -> dict:
+    global _CHAT_DOCUMENTS
+    try:
+        _CHAT_DOCUMENTS = db.get_all_chat_documents()
+    except Exception:
+        logger.exception("No se pudieron leer los documentos por chat; se usa el predeterminado")
+        _CHAT_DOCUMENTS = {}
+    return _CHAT_DOCUMENTS
+
+def chat_documents(chat_id: int) -> List[str]:
+    if _CHAT_DOCUMENTS is None:
+        load_chat_documents()
+    return _CHAT_DOCUMENTS.get(chat_id)
+
+async def documents_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/documentos [a.pdf, b.pdf | predeterminado] — ver o (administradores) cambiar los PDFs del chat."""
+    chat_id = update.effective_chat.id
+    raw = " ".join(context.args or []).strip()
+    if raw:
+        if not is_admin(update):
+            await send_reply(update, context, "Solo los administradores pueden cambiar los documentos del chat.", fast=True)
+            return
+        loop = asyncio.get_running_loop()
+        if raw.lower() in ("predeterminado", "default", "reset"):
+            await loop.run_in_executor(None, db.clear_chat_documents, chat_id)
+            if _CHAT_DOCUMENTS is not None:
+                _CHAT_DOCUMENTS.pop(chat_id, None)
+        else:
+            paths = [_resolve_document_path(p) for p in raw.split(",") if p.strip()]
+            missing = [p for p in paths if not os.path.isfile(p) or not p.lower().endswith(".pdf")]
+            if missing:
+                await send_reply(update, context, f"No encuentro estos PDFs: {', '.join(missing)}", fast=True)
+                return
+            paths = list(document_set_key(paths))
+            await loop.run_in_executor(None, db.set_chat_documents, chat_id, paths)
+            if _CHAT_DOCUMENTS is not None:
+                _CHAT_DOCUMENTS[chat_id] = paths
+
+    paths = chat_documents(chat_id)
+    if paths:
+        msg = "Este chat consulta:\n" + "\n".join(f" - {os.path.basename(p)}" for p in paths)
+    else:
+        msg = f"Este chat usa el documento predeterminado: {os.path.basename(PDF_PATH)}"
+    if is_admin(update):
+        msg += f"\n\n{KB_STORE.describe()}"
+    await send_reply(update, context, msg, fast=True)
+
+async def get_chat_kb(chat_id: int) -> KnowledgeBase:
+    """KB de los documentos asignados al chat, o la KB global si no tiene ninguno.
+    La construcción (si hace falta) ocurre una sola vez aunque lleguen varias preguntas."""
     global KB
+    paths = chat_documents(chat_id)
+    loop = asyncio.get_running_loop()
+    if paths:
+        return await loop.run_in_executor(None, KB_STORE.get, document_set_key(paths))
+    if KB is None:
+        logger.warning("KB no está cargada en memoria. Intentando construir desde PDF...")
+        pdf_path = os.getenv("PDF_PATH", PDF_PATH)
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError("La base de conocimiento no está cargada y no se encontró el PDF para construirla.")
+        kb = await loop.run_in_executor(None, KB_STORE.get, document_set_key([pdf_path]))
+        if KB is None:
+            KB = kb
+            logger.info("KB reconstruida dinámicamente desde PDF.")
+    return KB
+
+@profiling.profiled("ask")
+async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # El plazo cuenta desde que llega la pregunta (incluye construir la KB si hace falta)
+    token = CancelToken(REQUEST_DEADLINE)
     question = update.message.text.strip()
 
     # Dedupe: evitar responder dos veces al mismo mensaje
@@ -256,89 +972,95 @@ async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Si algo falla en la deduplicación, seguir de todas formas
         pass
     if not question:
-        await update.message.reply_text("Escribe una pregunta válida.")
+        await send_reply(update, context, "Escribe una pregunta válida.", fast=True)
         return
 
-    # Si la KB no está cargada, intentar construirla (bloqueante) en un executor
-    if KB is None:
-        logger.warning("KB no está cargada en memoria. Intentando construir desde PDF...")
-        pdf_path = os.getenv("PDF_PATH", PDF_PATH)
-        if not os.path.exists(pdf_path):
-            await update.message.reply_text("La base de conocimiento no está cargada y no se encontró el PDF para construirla.")
-            return
-        try:
-            loop = asyncio.get_running_loop()
-            KB = await loop.run_in_executor(None, build_kb_from_pdf, pdf_path)
-            logger.info("KB reconstruida dinámicamente desde PDF.")
-        except Exception as e:
-            logger.exception("Error construyendo KB dinámicamente")
-            await update.message.reply_text(f"Error construyendo la base de conocimiento: {e}")
-            return
+    # KB de los documentos del chat; se carga o construye (en un executor) la primera vez
+    chat_id = update.effective_chat.id
+    try:
+        kb = await get_chat_kb(chat_id)
+    except FileNotFoundError as e:
+        await send_reply(update, context, str(e))
+        return
+    except Exception as e:
+        logger.exception("Error construyendo KB dinámicamente")
+        await send_reply(update, context, f"Error construyendo la base de conocimiento: {e}")
+        return
 
     # Respuestas rápidas exactas
     if is_exact_match(question, GREETINGS):
-        await update.message.reply_text("¡Hola! Soy tu asistente académico. Pregúntame sobre el material del PDF cuando quieras.")
+        await send_reply(update, context, "¡Hola! Soy tu asistente académico. Pregúntame sobre el material del PDF cuando quieras.", fast=True)
         return
     if is_exact_match(question, THANKS):
-        await update.message.reply_text("¡Con gusto! Si necesitas algo más del material, aquí estoy.")
+        await send_reply(update, context, "¡Con gusto! Si necesitas algo más del material, aquí estoy.", fast=True)
         return
     if is_exact_match(question, BYE):
-        await update.message.reply_text("¡Hasta luego! Cuando quieras retomamos.")
+        await send_reply(update, context, "¡Hasta luego! Cuando quieras retomamos.", fast=True)
         return
 
-    # Recuperación basada en PDF
-    contexts = retrieve_context(KB, question, k=10)
-    max_score = max([score for _, _, score in contexts], default=0.0)
-
-    # Decidir si permitimos fallback a conocimiento general
-    allow_fallback_now = ALLOW_GENERAL_FALLBACK and (max_score < MIN_CONTEXT_SCORE)
-    if max_score < MIN_CONTEXT_SCORE:
-        logger.info("Contexto débil detectado.")
-
-    messages = build_prompt(contexts, question, limit_chars=7000)
-    if allow_fallback_now:
-        # permitir al modelo usar conocimiento general si el contexto no basta
-        messages[1]["content"] += (
-            "\n\nSi el contexto del documento no es suficiente, puedes responder usando conocimiento general. "
-            "Indica claramente cuando la respuesta proviene de fuera del documento."
-        )
-
+    # Una pregunta nueva del mismo usuario en el mismo chat cancela la anterior si sigue
+    # generándose; las de otros miembros de un grupo no se tocan
+    user = update.effective_user
+    active_key = request_key(chat_id, user.id if user is not None else None)
+    register_request(active_key, token)
     try:
-        # longitud máxima de la respuesta en caracteres (configurable)
-        max_reply_chars = int(os.getenv("MAX_REPLY_CHARS", "1000"))
-        answer = call_lmstudio(messages, temperature=0.3, max_tokens=300)
-        if answer and len(answer) > max_reply_chars:
-            # intentar cortar en el último punto para no romper frases
-            truncated = answer[:max_reply_chars]
-            if "." in truncated:
-                truncated = truncated.rsplit('.', 1)[0] + '.'
-            answer = truncated + "\n\n[Respuesta truncada por longitud]"
+        answer, contexts = await run_cancellable(answer_question, kb, question, token=token)
+    except RequestCancelled:
+        if token.reason == "plazo vencido":
+            logger.warning(f"Plazo vencido respondiendo en el chat {chat_id}")
+            await send_reply(update, context, DEADLINE_REPLY)
+        else:
+            logger.info(f"Pregunta cancelada en el chat {chat_id}: {token.reason}")
+        return
     except Exception as e:
         logger.exception("Error llamando al modelo")
-        await update.message.reply_text(f"Error llamando al modelo: {e}")
+        await send_reply(update, context, f"Error llamando al modelo: {e}")
         return
+    finally:
+        unregister_request(active_key, token)
+
+    reply = f"{answer}\n\nReferencias usadas:\n{format_references(contexts, kb)}"
+    await send_reply(update, context, reply, parse_mode=ParseMode.HTML)
 
-    refs = "\n".join([f"- Fragmento {idx} (score {score:.3f})" for idx, _, score in contexts])
-    reply = f"{answer}\n\nReferencias usadas:\n{refs}"
-    await update.message.reply_text(reply, parse_mode=ParseMode.HTML)
+async def _flush_outbound(app) -> None:
+    # post_stop y no post_shutdown: el bot sigue inicializado y puede enviar lo pendiente
+    await sender.shutdown_dispatcher()
 
-def main():
+def build_application(token: str):
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .post_stop(_flush_outbound)
+        .build()
+    )
+    load_chat_documents()
+    register_handlers(app)
+    return app
+
+def register_handlers(app):
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("profiling", profiling_cmd))
+    app.add_handler(CommandHandler("documentos", documents_cmd))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), ask))
+
+def main(kb: KnowledgeBase = None):
     global KB
-    if not os.path.exists(PDF_PATH):
-        raise FileNotFoundError(f"No se encuentra el PDF en {PDF_PATH}")
+    if kb is not None:
+        KB = kb
+    else:
+        if not os.path.exists(PDF_PATH):
+            raise FileNotFoundError(f"No se encuentra el PDF en {PDF_PATH}")
 
-    logger.info("Construyendo base de conocimiento desde el PDF...")
-    KB = build_kb_from_pdf(PDF_PATH)
+        logger.info("Construyendo base de conocimiento desde el PDF...")
+        KB = build_kb_from_pdf(PDF_PATH)
 
     logger.info("Levantando bot de Telegram...")
     if TELEGRAM_TOKEN.startswith("REEMPLAZA"):
         raise ValueError("Debes configurar TELEGRAM_TOKEN en variables de entorno.")
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), ask))
+    app = build_application(TELEGRAM_TOKEN)
 
     logger.info("Bot en ejecución. Ctrl+C para salir.")
     app.run_polling()
@@ -0,0 +1,152 @@
+import os
+import io
+import time
+import random
+import asyncio
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger("uni-bot")
+
+# -----------------------------
+# Configuración
+# -----------------------------
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", str(Path(__file__).parent / "profiles")))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "15"))
+# Frames guardados por asignación: cada frame extra encarece mucho la extracción del PDF
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "1"))
+
+class ProfilingState:
+    """Interruptor de profiling en caliente (GUI o comando de administrador)."""
+
+    def __init__(self):
+        self.enabled = os.getenv("PROFILING", "0") in ("1", "true", "True")
+        self.sample_rate = PROFILE_SAMPLE_RATE
+        self.lock = threading.Lock()
+        self.label_locks = {}
+
+    def set(self, enabled: bool, sample_rate: float = None) -> None:
+        self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        estado = "activado" if enabled else "desactivado"
+        logger.info(f"Profiling {estado} (muestreo {self.sample_rate:.0%}).")
+
+    def describe(self) -> str:
+        estado = "activado" if self.enabled else "desactivado"
+        return f"Profiling {estado}; muestreo {self.sample_rate:.0%}; resultados en {PROFILE_DIR}"
+
+STATE = ProfilingState()
+
+def _output_path(label: str, suffix: str) -> Path:
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}"
+    return PROFILE_DIR / f"{label}-{stamp}{suffix}"
+
+def _report_cprofile(prof: cProfile.Profile, label: str, elapsed: float) -> None:
+    path = _output_path(label, ".prof")
+    prof.dump_stats(str(path))
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    logger.info(f"Perfil de {label} ({elapsed:.2f}s) guardado en {path}\n{out.getvalue()}")
+
+def _start_profile(label: str):
+    """Devuelve (perfil, lock) si esta invocación debe muestrearse, o None."""
+    if not STATE.enabled or random.random() >= STATE.sample_rate:
+        return None
+    with STATE.lock:
+        lock = STATE.label_locks.setdefault(label, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return None
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # Otro perfilador ya está activo en este intérprete
+        lock.release()
+        return None
+    return prof, lock
+
+def _finish_profile(sample, label: str, started: float) -> None:
+    prof, lock = sample
+    prof.disable()
+    lock.release()
+    try:
+        _report_cprofile(prof, label, time.perf_counter() - started)
+    except Exception:
+        logger.exception(f"No se pudo guardar el perfil de {label}")
+
+def profiled(label: str):
+    """Decorador que perfila con cProfile una fracción de las invocaciones de `func`
+    (corrutina o función normal).
+
+    cProfile mide el hilo que lo activa: en handlers async el perfil incluye también
+    otras corrutinas del event loop, y el trabajo enviado a un executor no aparece (por
+    eso el pipeline que corre en hilos tiene su propio decorador). Solo se perfila una
+    invocación a la vez por etiqueta."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                sample = _start_profile(label)
+                if sample is None:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _finish_profile(sample, label, started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sample = _start_profile(label)
+            if sample is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _finish_profile(sample, label, started)
+        return wrapper
+    return decorator
+
+@contextmanager
+def trace_allocations(label: str):
+    """Registra con tracemalloc las asignaciones de memoria del bloque (si el profiling está activo)."""
+    if not STATE.enabled:
+        yield
+        return
+    logger.info(f"tracemalloc activo para {label}; la operación será notablemente más lenta.")
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        try:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            path = _output_path(label, ".tracemalloc")
+            after.dump(str(path))
+            top = after.compare_to(before, "lineno")[:PROFILE_TOP_N]
+            lines = "\n".join(str(stat) for stat in top)
+            logger.info(
+                f"Memoria de {label} ({time.perf_counter() - started:.2f}s): actual {current / 1e6:.1f}MB, "
+                f"pico {peak / 1e6:.1f}MB; snapshot en {path}\n{lines}"
+            )
+        except Exception:
+            logger.exception(f"No se pudo registrar la memoria de {label}")
+        finally:
+            if started_here:
+                tracemalloc.stop()
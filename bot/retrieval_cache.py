@@ -0,0 +1,65 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger("uni-bot")
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+# Cada cuántas consultas registrar la tasa de aciertos en el log
+RETRIEVAL_CACHE_LOG_EVERY = int(os.getenv("RETRIEVAL_CACHE_LOG_EVERY", "500"))
+
+@dataclass
+class CachedRetrieval:
+    q_vec: Any                    # vector disperso de la consulta
+    k: int                        # k con el que se calculó `top`
+    top: List[Tuple[int, float]]  # (índice del fragmento, similitud)
+
+class LRUCache:
+    """LRU acotado por número de entradas, seguro entre hilos, con contadores de aciertos."""
+
+    def __init__(self, maxsize: int, name: str = "caché"):
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            lookups = self.hits + self.misses
+        if RETRIEVAL_CACHE_LOG_EVERY and lookups % RETRIEVAL_CACHE_LOG_EVERY == 0:
+            logger.info(self.describe())
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def describe(self) -> str:
+        return (
+            f"{self.name}: {self.hit_rate():.1%} de aciertos ({self.hits}/{self.hits + self.misses}), "
+            f"{len(self._data)}/{self.maxsize} entradas"
+        )
@@ -0,0 +1,337 @@
+import os
+import re
+import time
+import asyncio
+import itertools
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger("uni-bot")
+
+# -----------------------------
+# Configuración de límites de Telegram
+# -----------------------------
+# Límite global de la Bot API (~30 mensajes/s); ráfaga + tasa no debe superarlo en un segundo
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+GLOBAL_BURST = float(os.getenv("SEND_GLOBAL_BURST", "5"))
+# Chats privados: ~1 mensaje por segundo con pequeñas ráfagas
+PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1"))
+PRIVATE_BURST = float(os.getenv("SEND_PRIVATE_BURST", "3"))
+# Grupos (chat_id negativo): ~20 mensajes por minuto
+GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+GROUP_BURST = float(os.getenv("SEND_GROUP_BURST", "5"))
+# Envíos concurrentes hacia la Bot API
+MAX_IN_FLIGHT = int(os.getenv("SEND_MAX_IN_FLIGHT", "8"))
+# Al detener el bot, cuánto esperar a que se vacíe la cola (incluida una pausa por 429)
+DRAIN_TIMEOUT = float(os.getenv("SEND_DRAIN_TIMEOUT", "10"))
+
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+
+# Puntos de corte preferidos, del más al menos deseable
+_SPLIT_PATTERNS = [
+    re.compile(r"\n\s*\n"),
+    re.compile(r"(?<=[.!?…])\s+"),
+    re.compile(r"\n"),
+    re.compile(r"\s+"),
+]
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE_CHARS) -> List[str]:
+    """Divide `text` en partes de como mucho `limit` caracteres, cortando preferentemente
+    entre párrafos o al final de una oración."""
+    parts = []
+    rest = text.strip()
+    while len(rest) > limit:
+        window = rest[:limit + 1]
+        cut = None
+        for pattern in _SPLIT_PATTERNS:
+            # Último separador dentro de la ventana, evitando partes demasiado cortas
+            matches = [m for m in pattern.finditer(window) if m.start() >= limit // 3]
+            if matches:
+                cut = matches[-1]
+                break
+        if cut is None:
+            parts.append(rest[:limit])
+            rest = rest[limit:].lstrip()
+        else:
+            parts.append(rest[:cut.start()].rstrip())
+            rest = rest[cut.end():].lstrip()
+    if rest:
+        parts.append(rest)
+    return parts
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Segundos hasta que haya un token disponible (0 si ya lo hay)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+_SEQUENCE = itertools.count()
+
+@dataclass(eq=False)
+class _Outgoing:
+    chat_id: int
+    text: str
+    kwargs: dict
+    future: asyncio.Future
+    attempts: int = 0
+    # Orden de llegada entre ambos carriles, para no adelantar mensajes del mismo chat
+    seq: int = field(default_factory=lambda: next(_SEQUENCE))
+
+@dataclass
+class SendStats:
+    sent: int = 0
+    failed: int = 0
+    retried_429: int = 0
+    split: int = 0
+    max_queue: int = 0
+    latencies: List[float] = field(default_factory=list, repr=False)
+
+    def describe(self) -> str:
+        ordered = sorted(self.latencies)
+        pct = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else 0.0
+        return (
+            f"Envíos a Telegram: {self.sent} enviados, {self.failed} fallidos, {self.retried_429} reintentos por 429, "
+            f"{self.split} respuestas divididas, cola máx. {self.max_queue}, "
+            f"latencia p50 {pct(0.5):.2f}s / p95 {pct(0.95):.2f}s"
+        )
+
+class OutboundDispatcher:
+    """Cola de envío hacia Telegram con token buckets global y por chat.
+
+    Los mensajes del carril rápido (respuestas cortas inmediatas) se despachan antes que
+    los del carril normal de otros chats, pero nunca adelantan a uno del mismo chat que
+    llegó antes (por ejemplo, la segunda parte de una respuesta dividida). Se honra
+    `retry_after` cuando la Bot API responde 429."""
+
+    def __init__(self, bot, max_in_flight: int = MAX_IN_FLIGHT):
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        self.max_in_flight = max_in_flight
+        self.stats = SendStats()
+        self._fast: deque = deque()
+        self._normal: deque = deque()
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._busy_chats: set = set()
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._in_flight = set()
+        self._worker: Optional[asyncio.Task] = None
+
+    # -----------------------------
+    # API pública
+    # -----------------------------
+    async def send(self, chat_id: int, text: str, fast: bool = False, **kwargs) -> list:
+        """Encola `text` (dividido si excede el límite de Telegram) y espera a que se envíe.
+        Devuelve la lista de mensajes enviados. `reply_parameters` solo se aplica a la
+        primera parte; el resto de `kwargs` (p. ej. `message_thread_id`) a todas."""
+        parts = split_message(text)
+        if len(parts) > 1:
+            self.stats.split += 1
+        reply_parameters = kwargs.pop("reply_parameters", None)
+        lane = self._fast if fast else self._normal
+        futures = []
+        for n, part in enumerate(parts):
+            fut = self.loop.create_future()
+            part_kwargs = dict(kwargs, reply_parameters=reply_parameters) if n == 0 and reply_parameters else kwargs
+            lane.append(_Outgoing(chat_id=chat_id, text=part, kwargs=part_kwargs, future=fut))
+            futures.append(fut)
+        self.stats.max_queue = max(self.stats.max_queue, self.queue_size())
+        self._ensure_worker()
+        self._wakeup.set()
+        return list(await asyncio.gather(*futures))
+
+    def queue_size(self) -> int:
+        return len(self._fast) + len(self._normal)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """Espera a que se envíe todo lo encolado, incluido lo retenido por un 429, hasta
+        `timeout` segundos. Devuelve False si quedaron mensajes sin enviar."""
+        deadline = self.loop.time() + timeout
+        while self.queue_size() or self._in_flight:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(0.05, remaining))
+        return True
+
+    async def close(self) -> None:
+        for task in list(self._in_flight):
+            task.cancel()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for item in list(self._fast) + list(self._normal):
+            if not item.future.done():
+                item.future.cancel()
+        self._fast.clear()
+        self._normal.clear()
+
+    # -----------------------------
+    # Despacho
+    # -----------------------------
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = self.loop.create_task(self._run())
+
+    def _bucket_for(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Olvidar buckets llenos: equivalen a uno recién creado
+                now = time.monotonic()
+                for cid in [c for c, b in self._chat_buckets.items() if b.is_full(now)]:
+                    del self._chat_buckets[cid]
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float):
+        """Devuelve (carril, item) listo para enviarse o (None, espera_mínima)."""
+        min_wait = None
+        # Primer mensaje pendiente de cada chat en el carril normal
+        normal_first: Dict[int, int] = {}
+        for item in self._normal:
+            normal_first[item.chat_id] = min(item.seq, normal_first.get(item.chat_id, item.seq))
+        for lane in (self._fast, self._normal):
+            blocked = set()
+            for item in lane:
+                if item.chat_id in blocked or item.chat_id in self._busy_chats:
+                    # Mantener el orden dentro del chat
+                    blocked.add(item.chat_id)
+                    continue
+                if lane is self._fast and normal_first.get(item.chat_id, item.seq) < item.seq:
+                    # Hay un mensaje anterior del mismo chat en el carril normal: va primero
+                    blocked.add(item.chat_id)
+                    continue
+                wait = self._bucket_for(item.chat_id).wait_time(now)
+                if wait == 0:
+                    return lane, item
+                blocked.add(item.chat_id)
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    async def _run(self) -> None:
+        while True:
+            if not self._fast and not self._normal:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            pause = max(self._paused_until - now, self._global.wait_time(now))
+            if pause > 0 or len(self._in_flight) >= self.max_in_flight:
+                await self._sleep(pause if pause > 0 else None)
+                continue
+
+            lane, item = self._pick(now)
+            if lane is None:
+                await self._sleep(item)
+                continue
+
+            lane.remove(item)
+            self._global.consume(now)
+            self._bucket_for(item.chat_id).consume(now)
+            self._busy_chats.add(item.chat_id)
+            task = self.loop.create_task(self._deliver(lane, item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _sleep(self, timeout: Optional[float]) -> None:
+        # Despertar antes si llega un mensaje nuevo o termina un envío
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver(self, lane: deque, item: _Outgoing) -> None:
+        started = time.monotonic()
+        try:
+            msg = await self.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            logger.warning(f"Límite de Telegram alcanzado (chat {item.chat_id}); reintentando en {seconds:.1f}s")
+            self.stats.retried_429 += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            item.attempts += 1
+            if item.attempts > 5:
+                self.stats.failed += 1
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                # Reencolar al frente para no alterar el orden del chat
+                lane.appendleft(item)
+        except Exception as e:
+            self.stats.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.stats.sent += 1
+            self.stats.latencies.append(time.monotonic() - started)
+            if len(self.stats.latencies) > 10000:
+                del self.stats.latencies[:5000]
+            if not item.future.done():
+                item.future.set_result(msg)
+        finally:
+            self._in_flight.discard(asyncio.current_task())
+            self._busy_chats.discard(item.chat_id)
+            self._wakeup.set()
+
+_DISPATCHER: Optional[OutboundDispatcher] = None
+
+def get_dispatcher(bot) -> OutboundDispatcher:
+    """Dispatcher asociado al bot y al event loop actuales (la GUI crea un loop nuevo en
+    cada arranque del bot)."""
+    global _DISPATCHER
+    loop = asyncio.get_running_loop()
+    if _DISPATCHER is None or _DISPATCHER.bot is not bot or _DISPATCHER.loop is not loop:
+        _DISPATCHER = OutboundDispatcher(bot)
+    return _DISPATCHER
+
+async def shutdown_dispatcher(timeout: float = DRAIN_TIMEOUT) -> None:
+    """Vacía y cierra el dispatcher del loop actual antes de que el loop se cierre, para no
+    perder respuestas encoladas ni dejar la tarea del worker pendiente."""
+    global _DISPATCHER
+    dispatcher = _DISPATCHER
+    if dispatcher is None or dispatcher.loop is not asyncio.get_running_loop():
+        return
+    if not await dispatcher.drain(timeout):
+        logger.warning(f"{dispatcher.queue_size()} mensajes sin enviar tras esperar {timeout:.0f}s al detener el bot.")
+    await dispatcher.close()
+    logger.info(dispatcher.stats.describe())
+    _DISPATCHER = None
@@ -0,0 +1,76 @@
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize as l2_normalize
+
+# Dimensión fija del espacio de hashing (memoria del vectorizador acotada)
+HASHING_N_FEATURES = int(os.getenv("HASHING_N_FEATURES", str(2 ** 20)))
+
+class HashingTfidfVectorizer:
+    """TF-IDF sobre feature hashing con frecuencias de documento incrementales.
+
+    A diferencia de `TfidfVectorizer` no guarda vocabulario: la memoria del vectorizador
+    es fija (`n_features` contadores) sea cual sea el tamaño del corpus, y se pueden
+    añadir fragmentos con `partial_fit` sin reajustar desde cero."""
+
+    def __init__(self, n_features: int = HASHING_N_FEATURES, stop_words: Optional[List[str]] = None,
+                 ngram_range=(1, 2), max_df: float = 0.9):
+        self.n_features = n_features
+        self.max_df = max_df
+        self.hasher = HashingVectorizer(
+            n_features=n_features,
+            lowercase=True,
+            stop_words=stop_words,
+            ngram_range=ngram_range,
+            alternate_sign=False,
+            norm=None,
+            # Los conteos crudos se guardan en la KB: float32 basta y ocupa la mitad
+            dtype=np.float32,
+        )
+        self.df = np.zeros(n_features, dtype=np.int32)
+        self.n_docs = 0
+        self._idf = None
+
+    def __getstate__(self):
+        # El IDF se recalcula bajo demanda; no hace falta persistirlo
+        state = self.__dict__.copy()
+        state["_idf"] = None
+        return state
+
+    def get_stop_words(self):
+        return self.hasher.get_stop_words()
+
+    def partial_fit(self, docs: Iterable[str]):
+        """Actualiza las frecuencias de documento y devuelve los conteos crudos de `docs`."""
+        counts = self.hasher.transform(docs).tocsr()
+        # Cada fila tiene índices únicos: contar apariciones por columna da la frecuencia de documento
+        self.df += np.bincount(counts.indices, minlength=self.n_features).astype(np.int32)
+        self.n_docs += counts.shape[0]
+        self._idf = None
+        return counts
+
+    def idf(self) -> np.ndarray:
+        if self._idf is None:
+            # Misma fórmula que TfidfVectorizer(smooth_idf=True)
+            idf = np.log((1.0 + self.n_docs) / (1.0 + self.df)) + 1.0
+            if self.n_docs:
+                # Equivalente a max_df: descartar términos demasiado frecuentes
+                idf[self.df > self.max_df * self.n_docs] = 0.0
+            self._idf = idf
+        return self._idf
+
+    def weight(self, counts):
+        """Aplica IDF y normalización L2 a una matriz de conteos crudos."""
+        weighted = sp.csr_matrix(counts, dtype=np.float64, copy=True)
+        weighted.data *= self.idf()[weighted.indices]
+        weighted.eliminate_zeros()
+        return l2_normalize(weighted, norm="l2", copy=False)
+
+    def fit_transform(self, docs: Iterable[str]):
+        return self.weight(self.partial_fit(docs))
+
+    def transform(self, docs: Iterable[str]):
+        return self.weight(self.hasher.transform(docs))